@@ -0,0 +1,4 @@
+-- Validators of last feed response of channel, sent back as If-None-Match and If-Modified-Since on next sync
+
+ALTER TABLE app_channel ADD COLUMN etag varchar(512) NULL;
+ALTER TABLE app_channel ADD COLUMN modified varchar(64) NULL;
@@ -0,0 +1,70 @@
+-- Materialized sort path of comments, run this script once on existing database
+-- Path of a comment is path of its parent followed by (-rank, comment_id), so ordering comments of a post by path
+-- returns depth first thread with replies of each comment by rank DESC, comment_id (Comment.path_page)
+
+ALTER TABLE app_comment ADD COLUMN sort_path double precision[];
+
+WITH RECURSIVE paths AS (
+    SELECT comment_id, ARRAY[-rank, comment_id::double precision] AS sort_path
+    FROM app_comment
+    WHERE reply_to_id IS NULL
+    UNION ALL
+    SELECT c.comment_id, p.sort_path || ARRAY[-c.rank, c.comment_id::double precision]
+    FROM app_comment c
+    JOIN paths p ON c.reply_to_id = p.comment_id
+)
+UPDATE app_comment c SET sort_path = p.sort_path FROM paths p WHERE c.comment_id = p.comment_id;
+
+CREATE INDEX app_comment_post_id_sort_path ON app_comment (post_id, sort_path);
+
+CREATE OR REPLACE FUNCTION set_comment_sort_path() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            NEW.sort_path := COALESCE((SELECT sort_path FROM app_comment WHERE comment_id = NEW.reply_to_id), '{}')
+                             || ARRAY[-NEW.rank, NEW.comment_id::double precision];
+        ELSE
+            NEW.sort_path[array_length(NEW.sort_path, 1) - 1] := -NEW.rank;
+        END IF;
+        RETURN NEW;
+    END;
+$$ LANGUAGE plpgsql;
+
+-- Paths of replies are rebuilt from current rows once per statement, one UPDATE (CommentVote.flush_counts) can change
+-- ranks of a comment and its replies together, transition tables need PostgreSQL 10
+-- Replies reached from several changed comments take path built from the topmost of them, it's the longest chain,
+-- the update of paths fires this trigger again and is skipped by trigger depth
+CREATE OR REPLACE FUNCTION move_comment_replies() RETURNS trigger AS $$
+    BEGIN
+        IF pg_trigger_depth() > 1 THEN
+            RETURN NULL;
+        END IF;
+
+        WITH RECURSIVE paths AS (
+            SELECT n.comment_id, n.sort_path, 0 AS level
+            FROM new_comments n
+            JOIN old_comments o ON n.comment_id = o.comment_id
+            WHERE n.rank IS DISTINCT FROM o.rank
+            UNION ALL
+            SELECT c.comment_id, p.sort_path || ARRAY[-c.rank, c.comment_id::double precision], p.level + 1
+            FROM app_comment c
+            JOIN paths p ON c.reply_to_id = p.comment_id
+        )
+        UPDATE app_comment c SET sort_path = p.sort_path
+        FROM (SELECT DISTINCT ON (comment_id) comment_id, sort_path FROM paths ORDER BY comment_id, level DESC) p
+        WHERE c.comment_id = p.comment_id AND c.sort_path IS DISTINCT FROM p.sort_path;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS app_comment_insert_sort_path ON app_comment;
+CREATE TRIGGER app_comment_insert_sort_path BEFORE INSERT ON app_comment
+    FOR EACH ROW EXECUTE PROCEDURE set_comment_sort_path();
+
+DROP TRIGGER IF EXISTS app_comment_update_sort_path ON app_comment;
+CREATE TRIGGER app_comment_update_sort_path BEFORE UPDATE OF rank ON app_comment
+    FOR EACH ROW WHEN (OLD.rank IS DISTINCT FROM NEW.rank) EXECUTE PROCEDURE set_comment_sort_path();
+
+DROP TRIGGER IF EXISTS app_comment_move_replies ON app_comment;
+CREATE TRIGGER app_comment_move_replies AFTER UPDATE ON app_comment
+    REFERENCING OLD TABLE AS old_comments NEW TABLE AS new_comments
+    FOR EACH STATEMENT EXECUTE PROCEDURE move_comment_replies();
@@ -1,26 +1,16 @@
-﻿-- Author: Faraz Masood Khan
+-- Generated by "python manage.py rank_sql" from tangleon/rank.py, don't edit
 -- Compute ranks
 
--- Compute rank based on time of submittion
-CREATE OR REPLACE FUNCTION compute_rank(votes integer, post_date timestamp with time zone) RETURNS numeric AS $$
-        BEGIN
-                RETURN trunc(CAST((log(GREATEST(abs(votes),1)) + (sign(votes) * extract(epoch from post_date)/45000)) AS numeric), 7);
-        END;
-$$ LANGUAGE plpgsql;
+DROP FUNCTION IF EXISTS compute_rank(integer, timestamp with time zone);
+DROP FUNCTION IF EXISTS compute_rank(integer, integer);
 
+-- Compute rank based on time of submittion, same as rank.hot
+CREATE FUNCTION compute_rank(votes integer, post_date timestamp with time zone) RETURNS double precision AS $$
+        SELECT (CASE WHEN ln(CAST(CASE WHEN abs(votes) > 1 THEN abs(votes) ELSE 1 END AS double precision)) / ln(CAST(10 AS double precision)) + (CASE WHEN votes > 0 THEN 1 WHEN votes < 0 THEN -1 ELSE 0 END) * ((CAST(extract(epoch FROM date_trunc('second', post_date::timestamp)) AS bigint) + CAST(extract(microseconds FROM post_date::timestamp) AS integer) % 1000000 / CAST(1000000 AS double precision)) - 1134028003) / 45000 > 0 THEN 1 WHEN ln(CAST(CASE WHEN abs(votes) > 1 THEN abs(votes) ELSE 1 END AS double precision)) / ln(CAST(10 AS double precision)) + (CASE WHEN votes > 0 THEN 1 WHEN votes < 0 THEN -1 ELSE 0 END) * ((CAST(extract(epoch FROM date_trunc('second', post_date::timestamp)) AS bigint) + CAST(extract(microseconds FROM post_date::timestamp) AS integer) % 1000000 / CAST(1000000 AS double precision)) - 1134028003) / 45000 < 0 THEN -1 ELSE 0 END) * floor(abs(ln(CAST(CASE WHEN abs(votes) > 1 THEN abs(votes) ELSE 1 END AS double precision)) / ln(CAST(10 AS double precision)) + (CASE WHEN votes > 0 THEN 1 WHEN votes < 0 THEN -1 ELSE 0 END) * ((CAST(extract(epoch FROM date_trunc('second', post_date::timestamp)) AS bigint) + CAST(extract(microseconds FROM post_date::timestamp) AS integer) % 1000000 / CAST(1000000 AS double precision)) - 1134028003) / 45000) * CAST(10000000.0 AS double precision) + CAST(0.5 AS double precision)) / CAST(10000000.0 AS double precision);
+$$ LANGUAGE sql STABLE;
 
--- Compute rank based on confidence of votes
-CREATE OR REPLACE FUNCTION compute_rank(up_votes integer, down_votes integer) RETURNS numeric AS $$
-	DECLARE
-	    z real := 1.0; -- 1.0 = 85%, 1.6 = 95%	    
-	    n integer := up_votes + down_votes;
-	    phat real := up_votes / GREATEST(n, 1);
-        BEGIN		
-		
-		IF n = 0 THEN
-		   RETURN 0.0;
-		END IF;
 
-		RETURN trunc(CAST((sqrt(phat+z*z/(2*n)-z*((phat*(1-phat)+z*z/(4*n))/n))/(1+z*z/n)) AS numeric), 7);
-        END;
-$$ LANGUAGE plpgsql;
+-- Compute rank based on confidence of votes, same as rank.rating
+CREATE FUNCTION compute_rank(up_votes integer, down_votes integer) RETURNS double precision AS $$
+        SELECT CASE WHEN up_votes + down_votes = 0 THEN CAST(0 AS double precision) ELSE ((CAST(up_votes AS double precision) / (up_votes + down_votes)) + CAST(1.96 AS double precision) * CAST(1.96 AS double precision) / (2 * (up_votes + down_votes)) - CAST(1.96 AS double precision) * sqrt(((CAST(up_votes AS double precision) / (up_votes + down_votes)) * (1 - (CAST(up_votes AS double precision) / (up_votes + down_votes))) + CAST(1.96 AS double precision) * CAST(1.96 AS double precision) / (4 * (up_votes + down_votes))) / (up_votes + down_votes))) / (1 + CAST(1.96 AS double precision) * CAST(1.96 AS double precision) / (up_votes + down_votes)) END;
+$$ LANGUAGE sql IMMUTABLE;
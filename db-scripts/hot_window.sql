@@ -0,0 +1,50 @@
+-- Hot window (app_hotpost) and its size (app_hotwindow) are created by syncdb, run this script once after it and then
+-- python manage.py compute_ranks to set size of window from HOT_WINDOW_SIZE and add top posts
+-- New posts are added to window and posts voted above size'th post of window are promoted into it,
+-- compute_ranks command removes old posts out of top posts
+
+-- Rank of size'th post of window, every post ranked above it is in window
+CREATE OR REPLACE FUNCTION hot_window_threshold() RETURNS double precision AS $$
+    SELECT rank FROM app_hotpost ORDER BY rank DESC, post_id DESC OFFSET (SELECT size - 1 FROM app_hotwindow) LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION add_hot_post() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO app_hotpost (post_id, rank) VALUES (NEW.post_id, NEW.rank) ON CONFLICT DO NOTHING;
+        RETURN NEW;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_hot_post_rank() RETURNS trigger AS $$
+    DECLARE
+        old_threshold double precision;
+    BEGIN
+        old_threshold := hot_window_threshold();
+        UPDATE app_hotpost SET rank = NEW.rank WHERE post_id = NEW.post_id;
+        IF FOUND THEN
+            -- A post of window ranked down lowers threshold, posts out of window ranked between new and old threshold
+            -- are pulled in from all posts
+            IF NEW.rank < OLD.rank THEN
+                INSERT INTO app_hotpost (post_id, rank)
+                SELECT post_id, rank FROM app_post WHERE rank > hot_window_threshold() AND rank <= old_threshold
+                ON CONFLICT DO NOTHING;
+            END IF;
+        ELSIF NEW.rank > old_threshold THEN
+            INSERT INTO app_hotpost (post_id, rank) VALUES (NEW.post_id, NEW.rank) ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NEW;
+    END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS app_post_add_hot_post ON app_post;
+CREATE TRIGGER app_post_add_hot_post AFTER INSERT ON app_post
+    FOR EACH ROW EXECUTE PROCEDURE add_hot_post();
+
+DROP TRIGGER IF EXISTS app_post_sync_hot_post_rank ON app_post;
+CREATE TRIGGER app_post_sync_hot_post_rank AFTER UPDATE OF rank ON app_post
+    FOR EACH ROW WHEN (OLD.rank IS DISTINCT FROM NEW.rank) EXECUTE PROCEDURE sync_hot_post_rank();
+
+-- Filling window with posts of last 30 days (Post.get_cut_off), top posts are added by compute_ranks
+INSERT INTO app_hotpost (post_id, rank)
+SELECT post_id, rank FROM app_post WHERE created_on > now() - interval '30 days'
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,5 @@
+-- Markdown of post description and comment text rendered to html once when they are saved, run this script once on
+-- existing database and then backfill_markdown command to render html of existing posts and comments
+
+ALTER TABLE app_post ADD COLUMN description_html text;
+ALTER TABLE app_comment ADD COLUMN comment_html text;
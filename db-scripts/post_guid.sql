@@ -0,0 +1,19 @@
+-- Rehashes guid of existing posts with Post.make_guid, first 8 bytes of md5 digest as signed bigint,
+-- and adds unique (channel_id, guid) index used by idempotent inserts of synced posts
+-- Guids were built from untruncated links, rows with links longer than 1024 characters get guids of stored link
+
+BEGIN;
+
+UPDATE app_post p SET guid = ('x' || substr(md5(c.url || '#' || p.link), 1, 16))::bit(64)::bigint
+FROM app_channel c WHERE p.channel_id = c.channel_id;
+
+UPDATE app_post p SET guid = ('x' || substr(md5(u.username || '#' || p.link), 1, 16))::bit(64)::bigint
+FROM app_user u WHERE p.channel_id IS NULL AND p.user_id = u.user_id;
+
+-- Posts duplicated by earlier syncs keep a guid of their own so unique index can be created
+UPDATE app_post p SET guid = -p.post_id
+WHERE p.channel_id IS NOT NULL AND EXISTS (SELECT 1 FROM app_post d WHERE d.channel_id = p.channel_id AND d.guid = p.guid AND d.post_id < p.post_id);
+
+CREATE UNIQUE INDEX app_post_channel_id_guid ON app_post (channel_id, guid);
+
+COMMIT;
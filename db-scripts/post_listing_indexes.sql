@@ -0,0 +1,8 @@
+-- Indexes for keyset pagination of post listings, new databases get them from index_together of Post model
+-- Listings seek with (rank, post_id) < (last_rank, last_post_id) or post_id < last_post_id
+
+CREATE INDEX app_post_rank_post_id ON app_post (rank, post_id);
+CREATE INDEX app_post_channel_id_rank_post_id ON app_post (channel_id, rank, post_id);
+CREATE INDEX app_post_channel_id_post_id ON app_post (channel_id, post_id);
+CREATE INDEX app_post_user_id_rank_post_id ON app_post (user_id, rank, post_id);
+CREATE INDEX app_post_user_id_post_id ON app_post (user_id, post_id);
@@ -0,0 +1,17 @@
+-- Post tags association (app_posttag) is created by syncdb, run this script once after it and then
+-- python manage.py backfill_post_tags to associate existing posts with their tags
+
+-- Case insensitive tag name lookups of Tag.add_tags and PostTag.add_post_tags
+CREATE INDEX app_tag_lower_name ON app_tag (lower(name));
+
+-- Keeps copy of post rank in app_posttag in sync so tag and room pages are ordered by (tag_id, rank, post_id) index
+CREATE OR REPLACE FUNCTION sync_post_tag_rank() RETURNS trigger AS $$
+    BEGIN
+        UPDATE app_posttag SET rank = NEW.rank WHERE post_id = NEW.post_id;
+        RETURN NEW;
+    END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS app_post_sync_post_tag_rank ON app_post;
+CREATE TRIGGER app_post_sync_post_tag_rank AFTER UPDATE OF rank ON app_post
+    FOR EACH ROW WHEN (OLD.rank IS DISTINCT FROM NEW.rank) EXECUTE PROCEDURE sync_post_tag_rank();
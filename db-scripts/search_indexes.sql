@@ -0,0 +1,13 @@
+-- Indexes for searching posts by title, tags and channel title
+-- Trigram GIN indexes serve ILIKE '%q%' matching of Post.tag_posts and are maintained by PostgreSQL on every insert or update
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX app_post_title_trgm ON app_post USING gin (title gin_trgm_ops);
+CREATE INDEX app_post_tags_trgm ON app_post USING gin (tags gin_trgm_ops);
+CREATE INDEX app_channel_title_trgm ON app_channel USING gin (title gin_trgm_ops);
+
+-- Case insensitive exact lookups (iexact) of search view
+CREATE INDEX app_channel_upper_title ON app_channel (upper(title));
+CREATE INDEX app_tag_upper_name ON app_tag (upper(name));
+CREATE INDEX app_user_upper_username ON app_user (upper(username));
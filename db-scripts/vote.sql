@@ -0,0 +1,77 @@
+-- Atomic votes of PostVote.vote and CommentVote.vote
+-- Vote of user is locked, changed and all counters and rank are updated in one call, it returns (vote_index, net_effect)
+-- Same vote again makes it zero, e.g. up vote on up voted post returns (0, -1)
+-- With p_update_counts false post or comment counters are left to flush_votes command (VOTE_WRITE_BEHIND setting)
+
+DROP FUNCTION IF EXISTS vote_post(bigint, bigint, integer, varchar);
+DROP FUNCTION IF EXISTS vote_comment(bigint, bigint, integer, varchar);
+
+CREATE OR REPLACE FUNCTION vote_post(p_post_id bigint, p_user_id bigint, p_vote integer, p_by varchar, p_update_counts boolean DEFAULT true) RETURNS TABLE (vote_index integer, net_effect integer) AS $$
+        DECLARE
+            old_vote integer;
+            new_vote integer;
+            up_delta integer;
+            down_delta integer;
+        BEGIN
+                INSERT INTO app_postvote (post_id, user_id, vote, updated_on, updated_by, created_on, created_by)
+                VALUES (p_post_id, p_user_id, 0, now(), p_by, now(), p_by)
+                ON CONFLICT (post_id, user_id) DO NOTHING;
+
+                SELECT vote INTO old_vote FROM app_postvote WHERE post_id = p_post_id AND user_id = p_user_id FOR UPDATE;
+                new_vote := CASE WHEN old_vote = p_vote THEN 0 ELSE p_vote END;
+                up_delta := (new_vote > 0)::integer - (old_vote > 0)::integer;
+                down_delta := (new_vote < 0)::integer - (old_vote < 0)::integer;
+
+                UPDATE app_postvote SET vote = new_vote, updated_on = now(), updated_by = p_by WHERE post_id = p_post_id AND user_id = p_user_id;
+                UPDATE app_user SET up_votes = up_votes + up_delta, down_votes = down_votes + down_delta WHERE user_id = p_user_id;
+                IF p_update_counts THEN
+                    UPDATE app_post SET up_votes = up_votes + up_delta, 
+                                        down_votes = down_votes + down_delta,
+                                        votes = (up_votes - down_votes + new_vote - old_vote),
+                                        rank = compute_rank(up_votes - down_votes + new_vote - old_vote, created_on)
+                    WHERE post_id = p_post_id;
+                END IF;
+
+                vote_index := new_vote;
+                net_effect := new_vote - old_vote;
+                RETURN NEXT;
+        END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION vote_comment(p_comment_id bigint, p_user_id bigint, p_vote integer, p_by varchar, p_update_counts boolean DEFAULT true) RETURNS TABLE (vote_index integer, net_effect integer) AS $$
+        DECLARE
+            old_vote integer;
+            new_vote integer;
+            up_delta integer;
+            down_delta integer;
+        BEGIN
+                INSERT INTO app_commentvote (comment_id, user_id, vote, updated_on, updated_by, created_on, created_by)
+                VALUES (p_comment_id, p_user_id, 0, now(), p_by, now(), p_by)
+                ON CONFLICT (comment_id, user_id) DO NOTHING;
+
+                SELECT vote INTO old_vote FROM app_commentvote WHERE comment_id = p_comment_id AND user_id = p_user_id FOR UPDATE;
+                new_vote := CASE WHEN old_vote = p_vote THEN 0 ELSE p_vote END;
+                up_delta := (new_vote > 0)::integer - (old_vote > 0)::integer;
+                down_delta := (new_vote < 0)::integer - (old_vote < 0)::integer;
+
+                UPDATE app_commentvote SET vote = new_vote, updated_on = now(), updated_by = p_by WHERE comment_id = p_comment_id AND user_id = p_user_id;
+                UPDATE app_user SET up_votes = up_votes + up_delta, down_votes = down_votes + down_delta WHERE user_id = p_user_id;
+                IF p_update_counts THEN
+                    UPDATE app_comment SET up_votes = up_votes + up_delta, 
+                                           down_votes = down_votes + down_delta,
+                                           votes = (up_votes - down_votes + new_vote - old_vote),
+                                           rank = compute_rank(up_votes + up_delta, down_votes + down_delta)
+                    WHERE comment_id = p_comment_id;
+                END IF;
+
+                vote_index := new_vote;
+                net_effect := new_vote - old_vote;
+                RETURN NEXT;
+        END;
+$$ LANGUAGE plpgsql;
+
+
+-- Indexes for finding votes changed since last flush of flush_votes command
+CREATE INDEX IF NOT EXISTS app_postvote_updated_on ON app_postvote (updated_on);
+CREATE INDEX IF NOT EXISTS app_commentvote_updated_on ON app_commentvote (updated_on);
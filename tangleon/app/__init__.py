@@ -6,6 +6,8 @@ Django app of TangleOn main website
 
 
 from django.contrib.auth.models import AnonymousUser as AuthAnonymousUser
+from django.utils.functional import SimpleLazyObject
+from tangleon import cache
 from tangleon.app.models import User
 
 SESSION_KEY = '_tangleon_app_user_session_id'
@@ -37,42 +39,46 @@ class AnonymousUser(AuthAnonymousUser):
     
 class AppMiddleware(object):
     """
-    Attaches user object and visit count to every request 
+    Attaches user object and visit count to every request, runs cache calls deferred until transaction of view ends
     """
     def process_request(self, request):
         assert hasattr(request, 'session'), "The app authentication middleware requires session middleware to be installed. Edit your MIDDLEWARE_CLASSES setting to insert 'django.contrib.sessions.middleware.SessionMiddleware'."                
-        try:           
-            user_id = request.session[SESSION_KEY]
-            try:
-                user = User.objects.prefetch_related('fbuser_set').get(user_id=user_id)
-                fbusers = user.fbuser_set.all()[:1]
-                if fbusers:
-                    user.fbuser = fbusers[0]
-                    user.fb_id = fbusers[0].fb_id
-
-                request.app_user = user if user.is_active else AnonymousUser()                 
-            except User.DoesNotExist:
-                request.app_user = AnonymousUser()
-        except KeyError:
-            request.app_user = AnonymousUser()
+        # User is read from session and cache on first access, so views not using it make no queries for it
+        request.app_user = SimpleLazyObject(lambda: get_app_user(request))
         
         try:
             request.visits = int(request.COOKIES['visits']) if 'visits' in request.COOKIES else 0
         except:
             request.visits = 0
-                    
-        request.app_user.ip = request.META.get('REMOTE_ADDR', 'unknown')
+        
         return None
     
     def process_response(self, request, response):
         """
-        Set visits count in cookie
+        Set visits count in cookie, commit_on_success of view has committed by now
         """            
+        cache.run_after_commit()
         response.set_cookie('visits', 0)#request.visits + 1)
         
         return response
 
     
+def get_app_user(request):
+    """
+    Returns active user of the session or anonymous user
+    """
+    user = None
+    user_id = request.session.get(SESSION_KEY)
+    if user_id:
+        user = User.get_cached(user_id)
+    
+    if user is None or not user.is_active:
+        user = AnonymousUser()
+    
+    user.ip = request.META.get('REMOTE_ADDR', 'unknown')
+    return user
+
+
 def login_user(request, user):
     """
     Persist a user id and a backend in the request. This way a user doesn't
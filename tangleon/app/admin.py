@@ -27,6 +27,7 @@ class PostAdmin(admin.ModelAdmin):
     list_display = ('title', 'link', 'votes', 'up_votes', 'down_votes', 'rank',)
     list_filter = ('is_muted', 'published', 'created_on',)
     search_fields = ('post_id', 'title', 'author', 'tags', 'slug',)
+    exclude = ('description_html',) # Rendered from description by Post.save
     date_hierarchy = 'published'
     ordering = ('-published',)
 
@@ -59,6 +60,7 @@ class CommentAdmin(admin.ModelAdmin):
     list_display = ('post', 'user', 'comment_text', 'reply_count',)
     list_filter = ('reply_count', 'is_muted',)
     search_fields = ('post__post_id', 'post__title', 'comment_text', 'user__user_id', 'user__username',)
+    exclude = ('comment_html',) # Rendered from comment text by Comment.save
     date_hierarchy = 'created_on'
     ordering = ('-created_on',)
  
@@ -12,30 +12,45 @@ from tangleon.app.forms import SignUp
 from tangleon.app.models import Tag, Channel
 
 
+class Lazy(object):
+    """
+    Context value computed on first use, templates call callable variables so value is never computed if not used
+    """
+    def __init__(self, func):
+        self.func = func
+    
+    def __call__(self):
+        if not hasattr(self, 'value'):
+            self.value = self.func()
+        return self.value
+
+
 def bootstrip(request):
     """
-    Setting basic context variables
+    Setting basic context variables, sidebar values are cached per user and read only if template uses them
     """
+    user = request.app_user
     user_messages = None
     new_messages = None
     last_message_id = None
     signup_form = None
     followings = None
     
-    if request.app_user.is_authenticated():
-        tags = request.app_user.get_tags()
-        channels = request.app_user.get_channels()
-        user_messages = request.app_user.get_messages()
-        followings = request.app_user.get_followings()
-        new_messages = len([msg for msg in user_messages if msg.viewed_on == None])
-        last_message_id = max(user_messages, key=lambda msg: msg.message_id).message_id if len(user_messages) else None
+    if user.is_authenticated():
+        tags = Lazy(lambda: user.get_sidebar('tags', user.get_tags))
+        channels = Lazy(lambda: user.get_sidebar('channels', user.get_channels))
+        user_messages = Lazy(lambda: user.get_sidebar('messages', user.get_messages))
+        followings = Lazy(lambda: user.get_sidebar('followings', user.get_followings))
+        new_messages = Lazy(lambda: len([msg for msg in user_messages() if msg.viewed_on == None]))
+        last_message_id = Lazy(lambda: max(user_messages(), key=lambda msg: msg.message_id).message_id if len(user_messages()) else None)
     else:
-        tags = Tag.get_tags()
-        channels = Channel.get_channels()
+        tags = Lazy(Tag.get_tags)
+        channels = Lazy(Channel.get_channels)
         signup_form = SignUp()
         
     return {
             'app_user': request.app_user,
+            'signed_in': user.is_authenticated(), # Used instead of request by templates of shared post fragments
             'tags': tags,
             'channels': channels,
             'user_messages': user_messages,
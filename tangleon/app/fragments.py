@@ -0,0 +1,85 @@
+"""
+Post page fragments rendered once for all users into versioned cache namespace of the post, votes of user, live vote
+counts and csrf token are injected into cached html on each request
+
+Fragments are invalidated when comments of post change, votes only change injected values
+"""
+
+import re
+
+from django.middleware.csrf import get_token
+from django.template import Context
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from tangleon import settings, cache
+
+CSRF_PLACEHOLDER = 'csrf-token-placeholder'
+
+# Vote links carry data-vote="<kind>-<id>" marker next to their class, e.g. class="up-vote " data-vote="comment-12"
+VOTE_LINK = re.compile(r'class="(up-vote|down-vote) " data-vote="([\w-]+)"')
+
+# Vote counters carry the same marker, e.g. <div class="votes" data-votes="comment-12">\n\t\t\t\t5
+VOTE_COUNT = re.compile(r'(data-votes="([\w-]+)">\s*)(-?\d+)')
+
+
+def namespace(post_id):
+    return 'post:%s' % post_id
+
+
+def invalidate(post_id):
+    """
+    Invalidates all cached fragments of post now and after commit, it's called when comments of post change
+    """
+    cache.bump_version_on_commit(namespace(post_id))
+
+
+def render(request, template_name, get_context, post_id, parts, votes=None, get_counts=None):
+    """
+    Returns html of template cached for post and parts, get_context is called only if fragment is not cached and must
+    return context shared by all users of parts, without request and votes of user. votes maps data-vote markers 
+    to vote of user, get_counts is called with data-votes markers of html and returns their current vote counts
+    """
+    def render_fragment():
+        context = Context(get_context())
+        context.update({'csrf_token': CSRF_PLACEHOLDER})
+        return render_to_string(template_name, context_instance=context)
+    
+    html = cache.get_or_set(namespace(post_id), (template_name,) + tuple(parts), render_fragment, settings.POST_FRAGMENT_CACHE_TIMEOUT)
+    html = html.replace(CSRF_PLACEHOLDER, get_token(request))
+    if votes:
+        html = inject_votes(html, votes)
+    
+    if get_counts:
+        html = inject_counts(html, get_counts)
+    
+    return mark_safe(html)
+
+
+def inject_votes(html, votes):
+    """
+    Turns on up or down vote links of voted markers in html
+    """
+    def turn_on(match):
+        link, marker = match.groups()
+        on = (link == 'up-vote' and votes.get(marker) == 1) or (link == 'down-vote' and votes.get(marker) == -1)
+        return 'class="%s %s-on" data-vote="%s"' % (link, link, marker) if on else match.group(0)
+    
+    return VOTE_LINK.sub(turn_on, html)
+
+
+def inject_counts(html, get_counts):
+    """
+    Replaces vote counts cached in html with current counts of their markers, counts missing in result are kept
+    """
+    markers = [marker for prefix, marker, count in VOTE_COUNT.findall(html)]
+    if not markers:
+        return html
+    
+    counts = get_counts(markers)
+    
+    def replace(match):
+        prefix, marker, count = match.groups()
+        return prefix + str(counts.get(marker, count))
+    
+    return VOTE_COUNT.sub(replace, html)
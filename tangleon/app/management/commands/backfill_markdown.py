@@ -0,0 +1,44 @@
+"""
+Command to store rendered html of existing posts and comments, run it once after adding html columns
+"""
+
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from tangleon.app import markup
+
+
+class Command(BaseCommand):
+    help = 'Renders markdown of post descriptions and comment texts which are not rendered yet'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000, help='Number of rows rendered in one transaction'),
+    )
+    
+    def handle(self, *args, **options):
+        self.backfill('app_post', 'post_id', 'description', 'description_html', options['chunk_size'])
+        self.backfill('app_comment', 'comment_id', 'comment_text', 'comment_html', options['chunk_size'])
+    
+    def backfill(self, table, id_column, text_column, html_column, chunk_size):
+        cursor = connection.cursor()
+        last_id = 0
+        while True:
+            cursor.execute('SELECT %s, %s FROM %s WHERE %s > %%s AND %s IS NULL AND %s IS NOT NULL ORDER BY %s LIMIT %%s'
+                           % (id_column, text_column, table, id_column, html_column, text_column, id_column), [last_id, chunk_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            params = []
+            for row_id, text in rows:
+                params.extend([row_id, markup.text_html(text)])
+            
+            cursor.execute('UPDATE %s SET %s = v.html FROM (VALUES %s) AS v (id, html) WHERE %s = v.id'
+                           % (table, html_column, ', '.join(['(%s::bigint, %s::text)'] * len(rows)), id_column), params)
+            transaction.commit_unless_managed()
+            
+            last_id = rows[-1][0]
+            self.stdout.write('Rendered %s up to %s' % (table, last_id))
+        
+        cursor.close()
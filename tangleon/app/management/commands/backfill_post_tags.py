@@ -0,0 +1,32 @@
+"""
+Command to associate existing posts with their tags, run it once after creating post tags table
+"""
+
+from optparse import make_option
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from tangleon.app.models import Post, Tag, PostTag
+
+
+class Command(BaseCommand):
+    help = 'Creates post tags association of existing posts from their comma separated tags'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000, help='Number of posts tagged in one transaction'),
+    )
+    
+    def handle(self, *args, **options):
+        last_post_id = 0
+        while True:
+            posts = list(Post.objects.filter(post_id__gt=last_post_id).only('post_id', 'rank', 'tags').order_by('post_id')[:options['chunk_size']])
+            if not posts:
+                break
+            
+            with transaction.commit_on_success():
+                tags = set(tag for post in posts for tag in (post.tags or '').split(',') if tag)
+                Tag.add_tags(tags, 'backfill_post_tags')
+                PostTag.add_post_tags(posts)
+            
+            last_post_id = posts[-1].post_id
+            self.stdout.write('Tagged posts up to %s' % last_post_id)
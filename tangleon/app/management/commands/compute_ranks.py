@@ -0,0 +1,69 @@
+"""
+Command to compute hot rank of all posts, run it periodically with cron
+"""
+
+from optparse import make_option
+
+import numpy
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from tangleon import rank
+from tangleon.app import postindex
+from tangleon.app.models import Post, HotPost
+
+
+class Command(BaseCommand):
+    help = 'Recomputes hot rank of posts in chunks and updates posts whose rank changed'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=50000, help='Number of posts read at once'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000, help='Number of posts updated by one statement'),
+    )
+    
+    def handle(self, *args, **options):
+        last_post_id = 0
+        changed = 0
+        cursor = connection.cursor()
+        try:
+            while True:
+                # Post dates are naive local times in Python, so epoch seconds are taken from local timestamp
+                cursor.execute('''
+                               SELECT post_id, votes, rank, 
+                                      extract(epoch FROM date_trunc('second', created_on::timestamp))::bigint,
+                                      extract(microseconds FROM created_on::timestamp)::integer %% 1000000
+                               FROM app_post 
+                               WHERE post_id > %s 
+                               ORDER BY post_id 
+                               LIMIT %s
+                               ''', [last_post_id, options['chunk_size']])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                
+                post_ids, votes, ranks, seconds, microseconds = (numpy.array(column) for column in zip(*rows))
+                new_ranks = rank.hot_array(votes, seconds + microseconds / 1000000.0)
+                changed_rows = numpy.nonzero(new_ranks != ranks.astype(numpy.float64))[0]
+                for start in range(0, len(changed_rows), options['batch_size']):
+                    batch = changed_rows[start:start + options['batch_size']]
+                    self.update_ranks(cursor, [(long(post_ids[i]), float(new_ranks[i])) for i in batch])
+                
+                transaction.commit_unless_managed()
+                changed += len(changed_rows)
+                last_post_id = rows[-1][0]
+        finally:
+            cursor.close()
+        
+        self.stdout.write('Updated rank of %s posts' % changed)
+        HotPost.refresh_window()
+        if changed:
+            postindex.request({'op': 'rebuild'})
+            Post.refresh_front_page()
+    
+    def update_ranks(self, cursor, post_ranks):
+        cursor.execute('''
+                       UPDATE app_post p SET rank = v.rank 
+                       FROM (VALUES %s) AS v(post_id, rank) 
+                       WHERE p.post_id = v.post_id
+                       ''' % ', '.join(['(%s::bigint, %s::double precision)'] * len(post_ranks)),
+                       [value for post_rank in post_ranks for value in post_rank])
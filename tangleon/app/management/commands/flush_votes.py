@@ -0,0 +1,49 @@
+"""
+Command to apply buffered votes to post and comment counters, run it as a long running process with VOTE_WRITE_BEHIND
+"""
+
+import time
+import datetime
+from optparse import make_option
+
+from django.db import connection
+from django.core.management.base import BaseCommand
+
+from tangleon import settings
+from tangleon.app.models import PostVote, CommentVote
+
+
+class Command(BaseCommand):
+    help = 'Periodically recounts votes of recently voted posts and comments and updates their counters and ranks'
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='int', dest='interval', default=None, help='Seconds between flushes'),
+        make_option('--replay', type='int', dest='replay', default=60, help='Minutes of votes recounted on start to recover from crash'),
+        make_option('--once', action='store_true', dest='once', default=False, help='Flush once and exit'),
+    )
+    
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.VOTE_FLUSH_INTERVAL
+        since = self.get_database_time() - datetime.timedelta(minutes=options['replay'])
+        while True:
+            # Votes are stamped with start time of their transaction, so flushes overlap to include late commits
+            posts, posts_flushed_on = PostVote.flush_counts(since)
+            comments, comments_flushed_on = CommentVote.flush_counts(since)
+            if posts or comments:
+                self.stdout.write('Flushed votes of %s posts and %s comments' % (posts, comments))
+            
+            if options['once']:
+                return
+            
+            since = min(posts_flushed_on, comments_flushed_on) - datetime.timedelta(seconds=interval)
+            time.sleep(interval)
+    
+    def get_database_time(self):
+        """
+        Returns current time of database, votes are compared with times of database and never with clock of this server
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT now()')
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
@@ -0,0 +1,14 @@
+"""
+Command to print SQL ranking functions generated from tangleon.rank, it is saved as db-scripts/compute_rank.sql
+"""
+
+from django.core.management.base import BaseCommand
+
+from tangleon import rank
+
+
+class Command(BaseCommand):
+    help = 'Prints PostgreSQL compute_rank functions generated from tangleon.rank'
+    
+    def handle(self, *args, **options):
+        self.stdout.write(rank.sql_functions(), ending='')
@@ -0,0 +1,17 @@
+"""
+Command to make running post index reload all posts from database
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tangleon.app import postindex
+
+
+class Command(BaseCommand):
+    help = 'Asks running post index to reload all posts from database'
+    
+    def handle(self, *args, **options):
+        if not postindex.request({'op': 'rebuild'}):
+            raise CommandError('Post index is not running or POST_INDEX_SOCKET is not set')
+        
+        self.stdout.write('Post index rebuild is queued')
@@ -0,0 +1,19 @@
+"""
+Command to refresh cached front page of TangleOn, run it after ranks are computed
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tangleon.app.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Invalidates cached pages of top and new posts and precomputes first pages of them'
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', type='int', dest='pages', default=None, help='Number of top and new pages to precompute'),
+    )
+    
+    def handle(self, *args, **options):
+        Post.refresh_front_page(options['pages'])
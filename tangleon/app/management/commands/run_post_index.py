@@ -0,0 +1,31 @@
+"""
+Command to serve in-memory post index to web workers on unix socket of POST_INDEX_SOCKET
+"""
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tangleon import settings
+from tangleon.app.postindex import Server
+
+
+class Command(BaseCommand):
+    help = 'Loads all posts into sorted listings in memory and serves pages of post ids on unix socket'
+    option_list = BaseCommand.option_list + (
+        make_option('--socket', dest='socket', default=None, help='Path of unix socket, defaults to POST_INDEX_SOCKET'),
+        make_option('--rebuild-interval', type='int', dest='rebuild_interval', default=3600, help='Seconds between full rebuilds of index'),
+    )
+    
+    def handle(self, *args, **options):
+        path = options['socket'] or settings.POST_INDEX_SOCKET
+        if not path:
+            raise CommandError('Socket path is not set, use --socket or TANGLE_ON_POST_INDEX_SOCKET')
+        
+        # Removing socket file left by previous process
+        if os.path.exists(path):
+            os.remove(path)
+        
+        self.stdout.write('Serving post index on %s' % path)
+        Server(path, options['rebuild_interval']).run()
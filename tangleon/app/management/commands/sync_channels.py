@@ -0,0 +1,20 @@
+"""
+Command to keep RSS channels in sync, run it as a long running process next to web workers
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tangleon.app.sync import Scheduler
+
+
+class Command(BaseCommand):
+    help = 'Syncs due RSS channels with a bounded pool of workers, multiple instances never sync the same channel'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None, help='Number of channels synced concurrently'),
+        make_option('--once', action='store_true', dest='once', default=False, help='Sync currently due channels and exit'),
+    )
+    
+    def handle(self, *args, **options):
+        Scheduler(options['workers']).run(options['once'])
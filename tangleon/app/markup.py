@@ -0,0 +1,42 @@
+"""
+Markdown rendering of user text, recently rendered texts are kept in LRU cache of each worker
+"""
+
+import threading
+from collections import OrderedDict
+
+import markdown2 as md2
+from django.utils.encoding import force_unicode
+from django.utils.html import strip_tags
+
+from tangleon import settings
+
+_lock = threading.Lock()
+_rendered = OrderedDict()
+
+
+def markdown(value):
+    """
+    Returns html of markdown text, last MARKDOWN_CACHE_SIZE rendered texts are returned from cache
+    """
+    value = force_unicode(value)
+    with _lock:
+        html = _rendered.pop(value, None)
+        if html is not None:
+            _rendered[value] = html
+            return html
+    
+    html = md2.markdown(value)
+    with _lock:
+        _rendered[value] = html
+        while len(_rendered) > settings.MARKDOWN_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    
+    return html
+
+
+def text_html(value):
+    """
+    Returns html of user text same as value|striptags|markdown2 in templates, it's stored with posts and comments
+    """
+    return markdown(strip_tags(value)) if value else None
@@ -7,23 +7,24 @@ Domain models for TangleOn app
 
 import re
 import random
+import struct
 import hashlib
 import datetime
-import thread
 import urllib
 import feedparser
 import HTMLParser
 import logging
 
 from django.db.models import F, Q
+from django.utils.safestring import mark_safe
 from django.contrib.sites.models import Site
 from django.db import models, connection, transaction
 from django.template.defaultfilters import slugify, truncatewords
 
-from tangleon import memoize, settings, TangleOnError
+from tangleon import memoize, settings, cache, TangleOnError
 from tangleon.db import models as db_models
-from tangleon.app import scraper
-from tangleon import rank 
+from tangleon.app import scraper, postindex, fragments, markup
+from tangleon import rank, paging
 
 # Get an instance of a logger
 logger = logging.getLogger('django.request')
@@ -113,6 +114,40 @@ class User(models.Model):
         """
         return FlashMessage.peek_messages(self)
     
+    def save(self, *args, **kwargs):
+        super(User, self).save(*args, **kwargs)
+        User.invalidate_cached(self.user_id)
+    
+    @classmethod
+    def get_cached(cls, user_id):
+        """
+        Returns user with its facebook user from cache for a short time, None if user doesn't exist
+        """
+        def get_user():
+            try:
+                user = cls.objects.prefetch_related('fbuser_set').get(user_id=user_id)
+            except cls.DoesNotExist:
+                return None
+            
+            # Slicing prefetched facebook users as list, slicing queryset would query them again
+            fbusers = list(user.fbuser_set.all())[:1]
+            if fbusers:
+                user.fbuser = fbusers[0]
+                user.fb_id = fbusers[0].fb_id
+            
+            return user
+        
+        return cache.get_or_set('app_user:%s' % user_id, (), get_user, settings.APP_USER_CACHE_TIMEOUT)
+    
+    @staticmethod
+    def invalidate_cached(user_id):
+        """
+        Invalidates cached user now and after commit, it's called on every save of user, on connecting facebook user and
+        after counters of user are updated in database (follower, post and comment counts, up and down votes by vote
+        stored procedures)
+        """
+        cache.bump_version_on_commit('app_user:%s' % user_id)
+    
     def login(self):
         """
         Sets last_logged_in time of user in database
@@ -123,29 +158,29 @@ class User(models.Model):
         self.updated_by = str(self.user_id)
         self.save()
         
-    def get_posts(self, page_index, page_size, sort_by_new, user):
+    def get_posts(self, page_index, page_size, sort_by_new, user, cursor=None):
         """
         Returns posts submitted by user
         """
-        return Post.user_posts(self, page_index, page_size, sort_by_new, user)
+        return Post.user_posts(self, page_index, page_size, sort_by_new, user, cursor)
             
-    def get_by_comments(self, page_index, page_size, login_user):
+    def get_by_comments(self, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user made any comments
         """
-        return Post.comment_posts(self, page_index, page_size, login_user)
+        return Post.comment_posts(self, page_index, page_size, login_user, cursor)
 
-    def get_by_messages(self, page_index, page_size, login_user):
+    def get_by_messages(self, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user made any comments
         """
-        return Post.messages_posts(self, page_index, page_size, login_user)
+        return Post.messages_posts(self, page_index, page_size, login_user, cursor)
 
-    def get_by_votes(self, page_index, page_size, login_user):
+    def get_by_votes(self, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user voted
         """
-        return Post.vote_posts(self, page_index, page_size, login_user)
+        return Post.vote_posts(self, page_index, page_size, login_user, cursor)
     
     def last_post(self):
         """
@@ -177,6 +212,20 @@ class User(models.Model):
         Returns user messages
         """
         return Message.get_messages(self)
+    
+    def get_sidebar(self, name, func):
+        """
+        Returns sidebar value of user from cache, func is called only if value is not cached
+        """
+        return cache.get_or_set('sidebar:%s' % self.user_id, (name,), func, settings.SIDEBAR_CACHE_TIMEOUT)
+    
+    @staticmethod
+    def invalidate_sidebar(user_id):
+        """
+        Invalidates cached sidebar values of user now and after commit, it's called on changes of pins, subscriptions,
+        followings and messages
+        """
+        cache.bump_version_on_commit('sidebar:%s' % user_id)
         
     @classmethod 
     def sign_up(cls, username, email, password):
@@ -384,6 +433,8 @@ class Follow(models.Model):
         if not cls.objects.filter(following=following, follower=follower).exists() and following.user_id != follower.user_id:
             cls.objects.create(following=following, follower=follower)
             User.objects.filter(user_id=following.user_id).update(follower_count=F('follower_count') + 1)
+            User.invalidate_cached(following.user_id)
+            User.invalidate_sidebar(follower.user_id)
     
     @classmethod
     def unfollow(cls, username, follower):
@@ -395,6 +446,8 @@ class Follow(models.Model):
             follow = cls.objects.get(following=following, follower=follower)
             follow.delete()
             User.objects.filter(user_id=following.user_id).update(follower_count=F('follower_count') - 1)
+            User.invalidate_cached(following.user_id)
+            User.invalidate_sidebar(follower.user_id)
         except cls.DoesNotExist:
             pass        
      
@@ -413,21 +466,21 @@ class Channel(models.Model):
     is_muted = models.BooleanField(default=False)
     sync_on = models.DateTimeField()        
     published = models.DateTimeField()
+    etag = models.CharField(max_length=512, blank=True, null=True) # Validators of last feed response for conditional GET
+    modified = models.CharField(max_length=64, blank=True, null=True)
     subscription_count = models.IntegerField(default=0)
     updated_on = models.DateTimeField(auto_now=True)
     updated_by = models.CharField(max_length=75)
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=75)
-    sync_lock = thread.allocate_lock()
-    sync_channel_ids = []
     
     def __unicode__(self):
         return unicode(self.title)   
     
-    def get_posts(self, page_index, page_size, sort_by_new, user):
+    def get_posts(self, page_index, page_size, sort_by_new, user, cursor=None):
         '''Returns all posts of the channel'''
         
-        return Post.channel_posts(self, page_index, page_size, sort_by_new, user)
+        return Post.channel_posts(self, page_index, page_size, sort_by_new, user, cursor)
     
     @models.permalink
     def get_absolute_url(self):
@@ -436,52 +489,90 @@ class Channel(models.Model):
         """       
         return ('app_channel', (self.channel_id,))
     
-    def sync(self, user, forced=None):
-        now = datetime.datetime.now()        
-        if not self.is_muted and self.subscription_count and (forced or self.sync_on < (now - datetime.timedelta(minutes=60))):
-            with Channel.sync_lock:
-                if self.channel_id in Channel.sync_channel_ids:
-                    return
-                Channel.sync_channel_ids.append(self.channel_id)
-                
-            thread.start_new_thread(self.sync_channel, (user,))                   
+    @classmethod
+    def due_channels(cls):
+        """
+        Returns (sync due time, channel id) of channels which should be kept in sync by sync_channels command
+        """
+        interval = datetime.timedelta(minutes=settings.SYNC_INTERVAL)
+        return [(sync_on + interval, channel_id) for channel_id, sync_on in 
+                cls.objects.filter(is_muted=False, subscription_count__gt=0).values_list('channel_id', 'sync_on')]
+    
+    @classmethod
+    def claim_sync(cls, channel_id, now):
+        """
+        Marks channel as synced if it is due and returns True, only one process can claim a channel within sync interval
+        """
+        cut_off = now - datetime.timedelta(minutes=settings.SYNC_INTERVAL)
+        return cls.objects.filter(channel_id=channel_id, is_muted=False, sync_on__lt=cut_off).update(sync_on=now) == 1
     
     def sync_channel(self, user):
+        """
+        Fetches RSS feed of channel and saves its new posts, it is run by workers of sync_channels command
+        """
         now = datetime.datetime.now()
-        try:                   
-            channel = Channel.objects.get(channel_id=self.channel_id)            
+        channel = Channel.objects.get(channel_id=self.channel_id)            
+        try:
+            rss = feedparser.parse(self.url, etag=channel.etag, modified=channel.modified)
+        except Exception:
+            raise TangleOnError('Error occurred while curling for RSS post.')
+        
+        if rss.get('status') == 304:
+            # Feed is not modified since last sync
+            Channel.objects.filter(channel_id=self.channel_id).update(sync_on=now, updated_by=str(user))
+            return
+                    
+        if not channel.description or not channel.icon_url:
+            icon_url, description = scraper.get_icon_url_and_description(rss.feed.link, rss.feed)
+            channel.description = description
+            channel.icon_url = icon_url
+            Channel.objects.filter(channel_id=self.channel_id).update(published=Post.get_date(rss.feed, now),
+                                                                      sync_on=now,
+                                                                      etag=rss.get('etag'),
+                                                                      modified=rss.get('modified'),
+                                                                      updated_by=str(user),
+                                                                      description=description,
+                                                                      icon_url=icon_url)
+        else:
+            Channel.objects.filter(channel_id=self.channel_id).update(published=Post.get_date(rss.feed, now),
+                                                                      sync_on=now,
+                                                                      etag=rss.get('etag'),
+                                                                      modified=rss.get('modified'),
+                                                                      updated_by=str(user))
+                    
+        candidates = []
+        for entry in rss.entries:
             try:
-                rss = feedparser.parse(self.url)
-            except Exception:
-                raise TangleOnError('Error occurred while curling for RSS post.')
-                        
-            if not channel.description or not channel.icon_url:
-                icon_url, description = scraper.get_icon_url_and_description(rss.feed.link, rss.feed)
-                channel.description = description
-                channel.icon_url = icon_url
-                Channel.objects.filter(channel_id=self.channel_id).update(published=Post.get_date(rss.feed, now),
-                                                                          sync_on=now,
-                                                                          updated_by=str(user),
-                                                                          description=description,
-                                                                          icon_url=icon_url)
-            else:
-                Channel.objects.filter(channel_id=self.channel_id).update(published=Post.get_date(rss.feed, now),
-                                                                          sync_on=now,
-                                                                          updated_by=str(user))
-                        
-            for entry in rss.entries:
-                try:
-                    guid = hash(channel.url + '#' + entry.link)
-                    title = html_parser.unescape(entry.title)
-                    if not Post.objects.filter(Q(guid=guid) | Q(title=title)).exists():
-                        post = Post.from_entry(channel, now, user, entry)
-                        post.save()
-                except TangleOnError: pass
-                except Exception as e: logger.exception(e)                
-        finally:            
-            with Channel.sync_lock:
-                if self.channel_id in Channel.sync_channel_ids:
-                    Channel.sync_channel_ids.remove(self.channel_id)     
+                candidates.append((Post.make_guid(channel.url + '#' + entry.link), html_parser.unescape(entry.title), entry))
+            except Exception as e: logger.exception(e)
+        
+        if not candidates:
+            return
+        
+        # Finding entries already saved as posts with one query
+        existing = Post.objects.filter(Q(channel=channel, guid__in=[guid for guid, title, entry in candidates]) | 
+                                       Q(title__in=[title for guid, title, entry in candidates])).values_list('guid', 'title')
+        guids = set(guid for guid, title in existing)
+        titles = set(title for guid, title in existing)
+        new_entries = []
+        for guid, title, entry in candidates:
+            if guid not in guids and title not in titles:
+                guids.add(guid)
+                titles.add(title)
+                new_entries.append(entry)
+        
+        # Fetching pages of new entries concurrently
+        media = scraper.MediaTags(entry.link for entry in new_entries)
+        posts = []
+        for entry in new_entries:
+            try:
+                posts.append(Post.from_entry(channel, now, user, entry, media))
+            except TangleOnError: pass
+            except Exception as e: logger.exception(e)
+        
+        if posts:
+            Post.save_new_posts(channel, posts, user)
+            cache.bump_version_on_commit('posts')
         
     @classmethod
     def subscribe(cls, url, user):
@@ -501,11 +592,14 @@ class Channel(models.Model):
                                                        channel=channel,
                                                        created_by=str(user))
             subscription.save()
+            User.invalidate_sidebar(user.user_id)
         return channel
 
     @classmethod
     def top_channels(cls, max_channels=10):
-        return [channel for channel in cls.objects.filter(is_muted=False, subscription_count__gt=2).order_by('-subscription_count')[:max_channels]]
+        return cache.get_or_set('channels', ('top', max_channels),
+                                lambda: [channel for channel in cls.objects.filter(is_muted=False, subscription_count__gt=2).order_by('-subscription_count')[:max_channels]],
+                                settings.FRONT_PAGE_CACHE_TIMEOUT)
 
     @classmethod
     def add_channel(cls, url, user):        
@@ -524,6 +618,8 @@ class Channel(models.Model):
                           description=description,
                           published=Post.get_date(feed, now),
                           sync_on=now,
+                          etag=rss.get('etag'),
+                          modified=rss.get('modified'),
                           updated_by=str(user),
                           created_by=str(user))
         
@@ -533,14 +629,17 @@ class Channel(models.Model):
             channel.title = 'RSS Channel ' + str(channel.channel_id)
             channel.save()
         
-        for entry in rss.entries:
-            post = Post.from_entry(channel, now, user, entry)
-            post.save()
+        media = scraper.MediaTags(entry.link for entry in rss.entries)
+        Post.save_new_posts(channel, [Post.from_entry(channel, now, user, entry, media) for entry in rss.entries], user)
+        
+        cache.bump_version_on_commit('posts')
         return channel
     
     @classmethod
     def get_channels(cls):
-        return list(cls.objects.filter(is_muted=False, is_default=True).order_by('channel_id'))
+        return cache.get_or_set('channels', ('default',),
+                                lambda: list(cls.objects.filter(is_muted=False, is_default=True).order_by('channel_id')),
+                                settings.FRONT_PAGE_CACHE_TIMEOUT)
 
 
 class Post(models.Model):
@@ -553,6 +652,7 @@ class Post(models.Model):
     guid = models.BigIntegerField()
     title = models.TextField(db_index=True)
     description = models.TextField(null=True, blank=True)
+    description_html = models.TextField(null=True, blank=True)
     slug = models.SlugField(max_length=256)
     link = models.URLField(max_length=1024)
     img_url = models.URLField(null=True, blank=True, max_length=1024)
@@ -573,8 +673,20 @@ class Post(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=75)
     
+    # Sort keys of post listings for keyset pagination
+    NEW_KEYSET = paging.Keyset(('p.post_id',), ('post_id',))
+    TOP_KEYSET = paging.Keyset(('p.rank', 'p.post_id'), ('rank', 'post_id'))
+    HOT_KEYSET = paging.Keyset(('h.rank', 'h.post_id'), ('rank', 'post_id'))
+    TAG_NEW_KEYSET = paging.Keyset(('pt.post_id',), ('post_id',))
+    TAG_TOP_KEYSET = paging.Keyset(('pt.rank', 'pt.post_id'), ('tag_rank', 'post_id'))
+    INDEX_TOP_KEYSET = paging.Keyset(('p.rank', 'p.post_id'), ('index_rank', 'post_id'))
+    COMMENTS_KEYSET = paging.Keyset(('uc.comment_id',), ('comment_id',))
+    MESSAGES_KEYSET = paging.Keyset(('ur.comment_id',), ('comment_id',))
+    VOTES_KEYSET = paging.Keyset(('uv.vote_id',), ('user_vote_id',))
+    
     class Meta:
-        unique_together = ('channel', 'user', 'link')
+        unique_together = (('channel', 'user', 'link'), ('channel', 'guid'))
+        index_together = [['rank', 'post_id'], ['channel', 'rank', 'post_id'], ['channel', 'post_id'], ['user', 'rank', 'post_id'], ['user', 'post_id']]
     
     @property
     def likes_percentage(self):
@@ -596,6 +708,9 @@ class Post(models.Model):
         """
         Returns confidence on post based on number of votes using Wilson's score interval
         """
+        if getattr(self, 'page_rating', None) is not None:
+            return self.page_rating
+        
         return round(rank.rating(self.up_votes, self.down_votes), 1)
     
     def is_text_post(self):
@@ -628,6 +743,31 @@ class Post(models.Model):
     def __unicode__(self):
         return unicode(self.title)       
     
+    def save(self, *args, **kwargs):
+        """
+        Saves post with html of its description, edits of saved post (e.g. in admin) invalidate its cached fragments
+        """
+        is_update = self.post_id is not None
+        self.description_html = markup.text_html(self.description)
+        super(Post, self).save(*args, **kwargs)
+        if is_update:
+            fragments.invalidate(self.post_id)
+    
+    def save_tags(self, user):
+        """
+        Creates tags of saved post if doesn't exist and associates post with them
+        """
+        tags = [tag for tag in (self.tags or '').split(',') if tag]
+        if tags:
+            Tag.add_tags(tags, user, self)
+    
+    @memoize.method
+    def get_description_html(self):
+        """
+        Returns html of markdown description stored with post or rendered for posts saved before it was stored
+        """
+        return mark_safe(self.description_html if self.description_html is not None else markup.text_html(self.description) or '')
+    
     @memoize.method     
     def tags_list(self):
         """
@@ -677,21 +817,25 @@ class Post(models.Model):
                                   created_by=str(user))
         
         post.link = url if url else get_site_url() + post.get_absolute_url()
-        post.guid = hash(str(user) + '#' + post.link)
+        post.guid = cls.make_guid(str(user) + '#' + post.link)
         post.save()
         
-        # Creating new tags
-        Tag.add_tags(tags.split(','), user)
+        # Creating new tags and associating post with them
+        post.save_tags(user)
+        postindex.touch([post.post_id])
         
         # Updating post count in user
         User.objects.filter(user_id=user.user_id).update(post_count=F('post_count') + 1)
+        User.invalidate_cached(user.user_id)
         
+        cache.bump_version_on_commit('posts')
         return post
         
     @classmethod
-    def read_post(cls, post_id, slug, user, comment_id=None, max_comments=20):
+    def read_post(cls, post_id, slug, user, comment_id=None, max_comments=20, more=None, after=None):
         """
-        Returns post with all it's comments sorted
+        Returns post with tree of its top comments, comments of a permalink or comments continued by more token,
+        comments of popular posts are read in pages by sort path
         """
         result = list(cls.objects.raw('''
                                       SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
@@ -708,123 +852,160 @@ class Post(models.Model):
         post = result[0]
         
         if not post.is_muted and max_comments:
-            if comment_id:            
-                comments = list(Comment.objects.raw('''
-                                                    SELECT c.*, v.vote AS vote_index
-                                                    FROM app_comment c
-                                                    LEFT OUTER JOIN app_commentvote v ON c.comment_id = v.comment_id AND v.user_id = %s
-                                                    WHERE c.post_id = %s AND c.comment_id >= %s 
-                                                    ORDER BY c.rank DESC, c.comment_id
-                                                    LIMIT %s
-                                                    ''', [user.user_id, post_id, comment_id, max_comments]))
-            else:
-                comments = list(Comment.objects.raw('''
-                                                    SELECT c.*, v.vote AS vote_index
-                                                    FROM app_comment c
-                                                    LEFT OUTER JOIN app_commentvote v ON c.comment_id = v.comment_id AND v.user_id = %s
-                                                    WHERE c.post_id = %s
-                                                    ORDER BY c.rank DESC, c.comment_id
-                                                    LIMIT %s
-                                                    ''', [user.user_id, post_id, max_comments]))                   
-            
-            post.loaded_comments = comments
-            if comment_id:
-                post.comments = [comment for comment in comments if comment.comment_id == comment_id]
-            else:
-                post.comments = [comment for comment in comments if comment.reply_to_id == None]
-            
-            
-            for comment in comments:
-                comment.post = post
-                comment.replies = [reply for reply in comments if reply.reply_to_id == comment.comment_id]
+            post.comments = post.load_comments(user, comment_id, more, after, max_comments)
+            post.loaded_comments = post.comments.loaded
         
         return post
+    
+    def load_comments(self, user, comment_id=None, more=None, after=None, max_comments=200):
+        """
+        Returns tree of comments of post with votes of user
+        """
+        if comment_id or more or self.comment_count < settings.COMMENT_PATH_MIN_COUNT or not Comment.has_sort_paths():
+            return Comment.load_thread(self, user, comment_id, more, max_comments)
+        
+        return Comment.path_page(self, user, after, max_comments)
         
     @classmethod
-    def get_posts(cls, page_index, page_size, sort_by_new, user, text_posts=True):
+    def get_posts(cls, page_index, page_size, sort_by_new, user, text_posts=True, cursor=None):
         """
-        Returns posts from all sources and user
-        """                
-        if sort_by_new:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (%s OR p.img_url IS NOT NULL)
-                        ORDER BY p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        else:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (%s OR p.img_url IS NOT NULL)
-                        ORDER BY p.rank DESC, p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, text_posts, page_size, page_index * page_size])]
-    
+        Returns posts from all sources and user, top posts are read from hot window until it runs out of posts
+        """
+        posts = cls.indexed_posts('posts' if text_posts else 'posts:image', page_index, page_size, sort_by_new, cursor)
+        if posts is not None:
+            return PostVote.overlay(posts, user)
+        
+        if not sort_by_new and not (cursor and cursor.backward):
+            posts = cls.hot_posts(page_index, page_size, text_posts, cursor)
+            if posts.next_cursor:
+                return PostVote.overlay(posts, user)
+        
+        sql_query = '''
+                    SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username
+                    FROM app_post p
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE p.is_muted = False AND (%s OR p.img_url IS NOT NULL) {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
+        
+        return PostVote.overlay(cls.paged_posts(sql_query, [text_posts], cls.sort_keyset(sort_by_new), page_index, page_size, cursor), user)
+    
     @classmethod
-    def channel_posts(cls, channel, page_index, page_size, sort_by_new, user):
+    def indexed_posts(cls, listing, page_index, page_size, sort_by_new, cursor=None):
+        """
+        Returns page of posts of listing with ids from post index and one query of posts, None if index can't serve it
+        """
+        keyset = cls.NEW_KEYSET if sort_by_new else cls.INDEX_TOP_KEYSET
+        cursor = keyset.fit(cursor)
+        
+        # Posts muted or deleted after index loaded them are dropped, so ids of two pages are fetched to fill the page
+        size = page_size * 2 + 1
+        keys = postindex.page_ids(listing, sort_by_new, cursor, page_index, page_size, size)
+        if keys is None:
+            return None
+        
+        post_ids = [post_id for rank, post_id in keys]
+        posts = dict((post.post_id, post) for post in cls.objects.raw('''
+                                                                      SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username
+                                                                      FROM app_post p
+                                                                      LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                                                                      LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                                                                      WHERE p.post_id = ANY(%s) AND p.is_muted = False
+                                                                      ''', [post_ids]))
+        # Cursors are read from ranks of index, ranks loaded from database can differ until index reloads touched posts
+        ranked = []
+        for rank, post_id in keys:
+            if post_id in posts:
+                posts[post_id].index_rank = rank
+                ranked.append(posts[post_id])
+        
+        posts = ranked
+        if len(posts) <= page_size and len(post_ids) == size:
+            # Too many stale ids to tell if there is a next page
+            return None
+        
+        return cls.rate(keyset.page(posts[:page_size + 1], page_size, cursor, page_index))
+    
+    @classmethod
+    def hot_posts(cls, page_index, page_size, text_posts=True, cursor=None):
+        """
+        Returns top posts from hot window ranked above its size'th post (HotWindow), those are same as top posts of all posts
+        """
+        sql_query = '''
+                    SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username
+                    FROM app_hotpost h
+                    INNER JOIN app_post p ON h.post_id = p.post_id
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE h.rank > (SELECT rank FROM app_hotpost ORDER BY rank DESC, post_id DESC OFFSET (SELECT size - 1 FROM app_hotwindow) LIMIT 1)
+                    AND p.is_muted = False AND (%s OR p.img_url IS NOT NULL) {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
+        
+        return cls.paged_posts(sql_query, [text_posts], cls.HOT_KEYSET, page_index, page_size, cursor)
+    
+    @classmethod
+    def front_page(cls, page_index, page_size, sort_by_new, user, text_posts=True, cursor=None):
+        """
+        Returns posts from all sources and user, all users share the same cached pages and only their votes are queried
+        """
+        cursor = cls.sort_keyset(sort_by_new).fit(cursor)
+        parts = ('front_page', page_index if not cursor else None, page_size, sort_by_new, text_posts, cursor.encode() if cursor else None)
+        posts = cache.get_or_set('posts', parts, lambda: cls.get_posts(page_index, page_size, sort_by_new, None, text_posts, cursor), settings.FRONT_PAGE_CACHE_TIMEOUT)
+        return PostVote.overlay(posts, user)
+    
+    @classmethod
+    def refresh_front_page(cls, max_pages=None):
+        """
+        Invalidates cached pages of all posts and precomputes first pages of top and new posts
+        """
+        cache.bump_version_on_commit('posts')
+        for sort_by_new in (False, True):
+            cursor = None
+            for _ in range(max_pages or settings.FRONT_PAGE_CACHED_PAGES):
+                posts = cls.front_page(0, settings.PAGE_SIZE, sort_by_new, None, cursor=cursor)
+                if not posts.next_cursor:
+                    break
+                cursor = paging.Cursor.decode(posts.next_cursor)
+    
+    @classmethod
+    def channel_posts(cls, channel, page_index, page_size, sort_by_new, user, cursor=None):
         """
         Returns post from particular channel
         """
-        if sort_by_new:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, NULL AS username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id                        
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.channel_id = %s AND p.is_muted = False
-                        ORDER BY p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        else:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, NULL AS username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id                        
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.channel_id = %s AND p.is_muted = False
-                        ORDER BY p.rank DESC, p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
+        sql_query = '''
+                    SELECT p.*, c.title AS channel_title, c.link AS channel_link, NULL AS username
+                    FROM app_post p
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id                        
+                    WHERE p.channel_id = %s AND p.is_muted = False {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
+        
+        posts = cls.indexed_posts('channel:%s' % channel.channel_id, page_index, page_size, sort_by_new, cursor)
+        if posts is not None:
+            return PostVote.overlay(posts, user)
             
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, channel.channel_id, page_size, page_index * page_size])]
+        return PostVote.overlay(cls.paged_posts(sql_query, [channel.channel_id], cls.sort_keyset(sort_by_new), page_index, page_size, cursor), user)
     
     @classmethod
-    def user_posts(cls, user, page_index, page_size, sort_by_new, login_user):
+    def user_posts(cls, user, page_index, page_size, sort_by_new, login_user, cursor=None):
         """
         Return posts of particular user
         """
-        if sort_by_new:
-            sql_query = '''
-                        SELECT p.*, NULL AS channel_title, NULL AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p                        
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.user_id = %s AND p.is_muted = False
-                        ORDER BY p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        else:
-            sql_query = '''
-                        SELECT p.*, NULL AS channel_title, NULL AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p                        
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.user_id = %s AND p.is_muted = False
-                        ORDER BY p.rank DESC, p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
+        sql_query = '''
+                    SELECT p.*, NULL AS channel_title, NULL AS channel_link, u.username
+                    FROM app_post p                        
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE p.user_id = %s AND p.is_muted = False {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
             
-        return [post for post in cls.objects.raw(sql_query, [login_user.user_id, user.user_id, page_size, page_index * page_size])]
+        return PostVote.overlay(cls.paged_posts(sql_query, [user.user_id], cls.sort_keyset(sort_by_new), page_index, page_size, cursor), login_user)
     
     @classmethod
     def users_posts(cls, page_index, page_size, sort_by_new=False):
@@ -839,135 +1020,177 @@ class Post(models.Model):
         return [post for post in posts.order_by('-rank', '-post_id')[page_index * page_size:(page_index + 1) * page_size]]
     
     @classmethod
-    def comment_posts(cls, user, page_index, page_size, login_user):
+    def comment_posts(cls, user, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user made any comments
         """
         sql_query = '''
-            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index, uc.comment_id, uc.comment_text, uc.created_on AS comment_date
+            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, uc.comment_id, uc.comment_text, uc.created_on AS comment_date
             FROM app_post p
             INNER JOIN app_comment uc ON p.post_id = uc.post_id AND uc.user_id = %s AND uc.is_muted = False AND p.is_muted = False
             LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
             LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-            LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s            
-            ORDER BY uc.comment_id DESC
+            WHERE True {seek}
+            ORDER BY {order_by}
             LIMIT %s OFFSET %s
             '''
         
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, login_user.user_id, page_size, page_index * page_size])]
+        return PostVote.overlay(cls.paged_posts(sql_query, [user.user_id], cls.COMMENTS_KEYSET, page_index, page_size, cursor), login_user)
 
     @classmethod
-    def messages_posts(cls, user, page_index, page_size, login_user):
+    def messages_posts(cls, user, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user has been commented to replied for any comment
         """
         sql_query = '''
-            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index, ur.comment_id, ur.comment_text, ur.created_by AS comment_by, ur.created_on AS comment_date
+            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, ur.comment_id, ur.comment_text, ur.created_by AS comment_by, ur.created_on AS comment_date
             FROM app_post p
             INNER JOIN app_comment ur ON p.post_id = ur.post_id AND ur.is_muted = False AND p.is_muted = False
             LEFT OUTER JOIN app_comment uc ON uc.comment_id = ur.reply_to_id AND uc.user_id = %s AND ur.user_id != %s
             LEFT OUTER JOIN app_post up ON ur.post_id = up.post_id AND up.user_id = %s AND ur.user_id != %s AND ur.reply_to_id is null
             LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
             LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-            LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-            WHERE uc.user_id IS NOT NULL or up.user_id  IS NOT NULL
-            ORDER BY ur.comment_id DESC
+            WHERE (uc.user_id IS NOT NULL or up.user_id  IS NOT NULL) {seek}
+            ORDER BY {order_by}
             LIMIT %s OFFSET %s
             '''
         
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, user.user_id, user.user_id, user.user_id, login_user.user_id, page_size, page_index * page_size])]
+        return PostVote.overlay(cls.paged_posts(sql_query, [user.user_id, user.user_id, user.user_id, user.user_id], cls.MESSAGES_KEYSET, page_index, page_size, cursor), login_user)
         
     @classmethod
-    def vote_posts(cls, user, page_index, page_size, login_user):
+    def vote_posts(cls, user, page_index, page_size, login_user, cursor=None):
         """
         Returns posts on which user voted
         """
         sql_query = '''
-            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
+            SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, uv.vote_id AS user_vote_id
             FROM app_post p
             INNER JOIN app_postvote uv ON p.post_id = uv.post_id
             LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
             LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-            LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-            WHERE uv.user_id = %s AND uv.vote <> 0 AND p.is_muted = False
-            ORDER BY uv.vote_id DESC
+            WHERE uv.user_id = %s AND uv.vote <> 0 AND p.is_muted = False {seek}
+            ORDER BY {order_by}
             LIMIT %s OFFSET %s
             '''
         
-        return [post for post in cls.objects.raw(sql_query, [login_user.user_id, user.user_id, page_size, page_index * page_size])]
+        return PostVote.overlay(cls.paged_posts(sql_query, [user.user_id], cls.VOTES_KEYSET, page_index, page_size, cursor), login_user)
     
     @classmethod
-    def tag_posts(cls, tag, page_index, page_size, sort_by_new, user):
+    def tag_posts(cls, tag, page_index, page_size, sort_by_new, user, cursor=None):
         """
-        Returns post of related tag found in title or tags field
+        Returns post of related tag found in title or tags field
+        
+        Matching is served by trigram indexes of db-scripts/search_indexes.sql, ids of matching channels are read
+        into an array first (a hashed IN sub plan can't be an index arm) so that title, tags and channel_id indexes
+        are combined in a single BitmapOr scan
         """        
         tag = '%' + tag + '%'
+        sql_query = '''
+                    SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username
+                    FROM app_post p
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE p.is_muted = False AND (p.title ILIKE %s OR p.tags ILIKE %s OR p.channel_id = ANY(ARRAY(SELECT channel_id FROM app_channel WHERE title ILIKE %s))) {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
+        
+        return PostVote.overlay(cls.paged_posts(sql_query, [tag, tag, tag], cls.sort_keyset(sort_by_new), page_index, page_size, cursor), user)
+
+    @classmethod
+    def tagged_posts(cls, tag, page_index, page_size, sort_by_new, user, cursor=None):
+        """
+        Returns posts associated with tag, served by range scan of (tag_id, rank) or (tag_id, post_id) index of post tags
+        
+        Tag is matched exactly (case insensitive) with tags of posts, substring matching of title, tags and channel
+        title is left to search page (tag_posts)
+        
+        Only new posts are read from post index, cursors of top posts are read from rank copied to post tags and must
+        not be mixed with ranks of index when index stops or starts serving
+        """
+        sql_query = '''
+                    SELECT p.*, pt.rank AS tag_rank, c.title AS channel_title, c.link AS channel_link, u.username
+                    FROM app_posttag pt
+                    INNER JOIN app_post p ON pt.post_id = p.post_id
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE pt.tag_id = (SELECT MIN(tag_id) FROM app_tag WHERE lower(name) = lower(%s)) AND p.is_muted = False {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
         
         if sort_by_new:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (p.title ILIKE %s OR p.tags ILIKE %s OR c.title ILIKE %s)
-                        ORDER BY p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        else:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (p.title ILIKE %s OR p.tags ILIKE %s OR c.title ILIKE %s)
-                        ORDER BY p.rank DESC, p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, tag, tag, tag, page_size, page_index * page_size])]  
+            posts = cls.indexed_posts('tag:%s' % tag.lower(), page_index, page_size, sort_by_new, cursor)
+            if posts is not None:
+                return PostVote.overlay(posts, user)
+        
+        keyset = cls.TAG_NEW_KEYSET if sort_by_new else cls.TAG_TOP_KEYSET
+        return PostVote.overlay(cls.paged_posts(sql_query, [tag], keyset, page_index, page_size, cursor), user)
 
     @classmethod
-    def room_posts(cls, room, page_index, page_size, sort_by_new, user):
+    def room_posts(cls, room, page_index, page_size, sort_by_new, user, cursor=None):
         """
         Returns post of related room found in first tag of tags field
         """
-        if sort_by_new:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (lower(p.tags) = lower(%s) OR p.tags ILIKE %s)
-                        ORDER BY p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        else:
-            sql_query = '''
-                        SELECT p.*, c.title AS channel_title, c.link AS channel_link, u.username, v.vote AS vote_index
-                        FROM app_post p
-                        LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
-                        LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
-                        LEFT OUTER JOIN app_postvote v ON p.post_id = v.post_id AND v.user_id = %s
-                        WHERE p.is_muted = False AND (lower(p.tags) = lower(%s) OR p.tags ILIKE %s)
-                        ORDER BY p.rank DESC, p.post_id DESC
-                        LIMIT %s OFFSET %s
-                        '''
-        
-        return [post for post in cls.objects.raw(sql_query, [user.user_id, room, (room + ',%'), page_size, page_index * page_size])]
+        sql_query = '''
+                    SELECT p.*, pt.rank AS tag_rank, c.title AS channel_title, c.link AS channel_link, u.username
+                    FROM app_posttag pt
+                    INNER JOIN app_post p ON pt.post_id = p.post_id
+                    LEFT OUTER JOIN app_channel c ON p.channel_id = c.channel_id
+                    LEFT OUTER JOIN app_user u ON p.user_id = u.user_id
+                    WHERE pt.tag_id = (SELECT MIN(tag_id) FROM app_tag WHERE lower(name) = lower(%s)) AND pt.position = 0 AND p.is_muted = False {seek}
+                    ORDER BY {order_by}
+                    LIMIT %s OFFSET %s
+                    '''
+        
+        keyset = cls.TAG_NEW_KEYSET if sort_by_new else cls.TAG_TOP_KEYSET
+        return PostVote.overlay(cls.paged_posts(sql_query, [room], keyset, page_index, page_size, cursor), user)
+    
+    @classmethod
+    def sort_keyset(cls, sort_by_new):
+        """
+        Returns keyset of new or top posts listing
+        """
+        return cls.NEW_KEYSET if sort_by_new else cls.TOP_KEYSET
+    
+    @classmethod
+    def paged_posts(cls, sql_query, params, keyset, page_index, page_size, cursor=None):
+        """
+        Returns page of posts seeking from cursor on keyset, or from page_index offset if cursor is not given
+        
+        sql_query must have {seek} in WHERE clause, {order_by} and LIMIT %s OFFSET %s at the end
+        """
+        cursor = keyset.fit(cursor)
+        condition, order_by, seek_params = keyset.seek(cursor)
+        sql_query = sql_query.format(seek=condition, order_by=order_by)
+        offset = 0 if cursor else page_index * page_size
+        
+        # Fetching one extra post to find out if there is a next page
+        posts = list(cls.objects.raw(sql_query, params + seek_params + [page_size + 1, offset]))
+        return cls.rate(keyset.page(posts, page_size, cursor, page_index))
+    
+    @staticmethod
+    def rate(posts):
+        """
+        Sets ratings of all posts of a page with one vectorized computation
+        """
+        if posts and rank.numpy is not None:
+            ratings = rank.round_array(rank.rating_array([post.up_votes for post in posts], [post.down_votes for post in posts]), 1)
+            for post, rating in zip(posts, ratings.tolist()):
+                post.page_rating = rating
+        
+        return posts
    
     @classmethod
-    def from_entry(cls, channel, now, user, entry):
+    def from_entry(cls, channel, now, user, entry, media=scraper):
         """
-        Creates Post object from entry object of RSS
+        Creates Post object from entry object of RSS, media is scraper or scraper.MediaTags of prefetched entry pages
         """
         tags = Tag.clean_tags(tag.term for tag in entry.tags) if 'tags' in entry else ''  
         author = entry.author_detail.name if 'author_detail' in entry else ''
         
         # Trying to get media info from post page
-        media_tags = scraper.get_media_tags(entry.link)
+        media_tags = media.get_media_tags(entry.link)
             
         # Getting first image url from RSS item description
         if not 'image' in media_tags:
@@ -981,7 +1204,7 @@ class Post(models.Model):
         vid_url = media_tags.get('video', None)
         vid_type = media_tags.get('video_type', None)
         return cls(channel=channel,
-                   guid=hash(channel.url + '#' + entry.link),
+                   guid=cls.make_guid(channel.url + '#' + entry.link),
                    title=html_parser.unescape(entry.title),
                    link=entry.link[:1024],
                    slug=slugify(truncatewords(entry.title, 10)),
@@ -996,6 +1219,49 @@ class Post(models.Model):
                    updated_by=str(user),
                    created_by=str(user))
     
+    @classmethod
+    def save_new_posts(cls, channel, posts, user):
+        """
+        Inserts new posts of channel with one statement and associates them with their tags,
+        posts already saved with same guid are skipped so syncing same entries twice is harmless
+        """
+        if not posts:
+            return
+        
+        fields = [field for field in cls._meta.local_fields if not isinstance(field, models.AutoField)]
+        sql_query = '''
+                    INSERT INTO app_post ({columns}) VALUES {values}
+                    ON CONFLICT DO NOTHING
+                    RETURNING post_id, guid
+                    '''.format(columns=', '.join(connection.ops.quote_name(field.column) for field in fields),
+                               values=', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(posts)))
+        params = [field.get_db_prep_save(field.pre_save(post, True), connection) for post in posts for field in fields]
+        
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql_query, params)
+            post_ids = dict((guid, post_id) for post_id, guid in cursor.fetchall())
+        finally:
+            cursor.close()
+        
+        saved_posts = [post for post in posts if post.guid in post_ids]
+        for post in saved_posts:
+            post.post_id = post_ids[post.guid]
+        
+        Tag.add_tags(set(tag for post in saved_posts for tag in (post.tags or '').split(',') if tag), user)
+        PostTag.add_post_tags(saved_posts)
+        postindex.touch(post.post_id for post in saved_posts)
+    
+    @staticmethod
+    def make_guid(value):
+        """
+        Returns stable 64 bit guid from md5 digest of value, db-scripts/post_guid.sql computes the same in SQL
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        
+        return struct.unpack('>q', hashlib.md5(value).digest()[:8])[0]
+    
     @staticmethod
     def get_date(post_or_entry, default):
         if 'published_parsed' in post_or_entry:
@@ -1005,6 +1271,9 @@ class Post(models.Model):
     
     @staticmethod
     def get_cut_off():
+        """
+        Returns time after which all posts are kept in hot window
+        """
         return datetime.datetime.now() - datetime.timedelta(days=30)
 
         
@@ -1029,28 +1298,39 @@ class Tag(models.Model):
         return unicode(self.name)
     
     @classmethod
-    def add_tags(cls, tags, user):
+    def add_tags(cls, tags, user, post=None):
         """
-        Create new tags in database if doesn't exists
+        Create new tags in database if doesn't exists and associate post with them
         """        
+        tags = list(tags)
+        if not tags:
+            return
+        
         sql = '''INSERT INTO app_tag (name, is_muted, is_default, pin_count, updated_by, updated_on) 
-                 SELECT %s, false, false, 0, %s, %s WHERE NOT EXISTS (SELECT 1 FROM app_tag WHERE lower(name) = lower(%s));'''
-        now = datetime.datetime.now()
-        parameters = ((tag, str(user), now, tag) for tag in tags)
+                 SELECT DISTINCT ON (lower(t.name)) t.name, false, false, 0, %s, %s FROM unnest(%s::text[]) AS t(name)
+                 WHERE NOT EXISTS (SELECT 1 FROM app_tag WHERE lower(name) = lower(t.name))
+                 ON CONFLICT DO NOTHING;'''
         cursor = connection.cursor()
         try:
-            cursor.executemany(sql, parameters)
+            cursor.execute(sql, [str(user), datetime.datetime.now(), tags])
         finally:
             cursor.close()
+        
+        if post is not None:
+            PostTag.add_post_tags([post])
         
     
     @classmethod
     def get_tags(cls):
-        return [tag for tag in cls.objects.filter(is_muted=False, is_default=True).order_by('tag_id')]
+        return cache.get_or_set('tags', ('default',),
+                                lambda: [tag for tag in cls.objects.filter(is_muted=False, is_default=True).order_by('tag_id')],
+                                settings.FRONT_PAGE_CACHE_TIMEOUT)
     
     @classmethod
     def top_tags(cls, max_tags=10):
-        return [tag for tag in cls.objects.filter(is_muted=False, pin_count__gt=2).order_by('-pin_count')[:max_tags]]
+        return cache.get_or_set('tags', ('top', max_tags),
+                                lambda: [tag for tag in cls.objects.filter(is_muted=False, pin_count__gt=2).order_by('-pin_count')[:max_tags]],
+                                settings.FRONT_PAGE_CACHE_TIMEOUT)
     
     @staticmethod
     def clean_tags(tags):
@@ -1060,6 +1340,100 @@ class Tag(models.Model):
         tags = (re.sub(r'[^\w\.@]', '', tag) for tag in tags) 
         tags = ','.join(tag for tag in tags if len(tag) > 1 and len(tag) <= 20)
         return tags
+
+
+class PostTag(models.Model):
+    """
+    Association of post with each of its tags, first tag of post (position 0) is its room
+    """
+    post_tag_id = db_models.BigAutoField(primary_key=True)
+    post = models.ForeignKey(Post)
+    tag = models.ForeignKey(Tag)
+    position = models.SmallIntegerField(default=0)
+    rank = models.FloatField(default=0) # Copy of post rank, kept in sync by trigger of db-scripts/post_tags.sql
+    
+    class Meta:
+        unique_together = ('post', 'tag')
+        index_together = [['tag', 'rank', 'post'], ['tag', 'post']]
+    
+    @classmethod
+    def add_post_tags(cls, posts):
+        """
+        Associates saved posts with tags of their tags field, tags must already exist in database
+        """
+        names = dict((post.post_id, [tag.lower() for tag in post.tags.split(',')]) for post in posts if post.tags)
+        tag_names = set(name for post_names in names.values() for name in post_names if name)
+        if not tag_names:
+            return
+        
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''SELECT lower(name), MIN(tag_id) FROM app_tag WHERE lower(name) = ANY(%s) GROUP BY lower(name)''', [list(tag_names)])
+            tag_ids = dict(cursor.fetchall())
+            
+            post_tags = []
+            added = set()
+            for post in posts:
+                for position, name in enumerate(names.get(post.post_id, [])):
+                    tag_id = tag_ids.get(name)
+                    if tag_id and (post.post_id, tag_id) not in added:
+                        added.add((post.post_id, tag_id))
+                        post_tags.append((post.post_id, tag_id, position, post.rank))
+            
+            # Posts tagged concurrently or already tagged are skipped by unique (post_id, tag_id) constraint
+            if post_tags:
+                cursor.execute('''INSERT INTO app_posttag (post_id, tag_id, position, rank) VALUES %s ON CONFLICT DO NOTHING'''
+                               % ', '.join(['(%s, %s, %s, %s)'] * len(post_tags)), [value for post_tag in post_tags for value in post_tag])
+        finally:
+            cursor.close()
+
+
+class HotPost(models.Model):
+    """
+    Hot window, candidate posts of top posts listing: posts after Post.get_cut_off and top posts by rank
+    
+    Posts are added on insert and ranks are synced on vote by triggers of db-scripts/hot_window.sql, 
+    every post ranked above size'th post of window (HotWindow) is in window
+    """
+    post = models.OneToOneField(Post, primary_key=True)
+    rank = models.FloatField(default=0)
+    
+    class Meta:
+        index_together = [['rank', 'post']]
+    
+    @classmethod
+    def refresh_window(cls):
+        """
+        Syncs ranks and size of window, adds missing top posts and removes posts older than cut off out of top posts
+        """
+        if not HotWindow.objects.update(size=settings.HOT_WINDOW_SIZE):
+            HotWindow.objects.create(size=settings.HOT_WINDOW_SIZE)
+        
+        size = settings.HOT_WINDOW_SIZE * 2
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''UPDATE app_hotpost h SET rank = p.rank FROM app_post p WHERE h.post_id = p.post_id AND h.rank <> p.rank''')
+            cursor.execute('''
+                           INSERT INTO app_hotpost (post_id, rank)
+                           SELECT t.post_id, t.rank FROM (SELECT post_id, rank FROM app_post ORDER BY rank DESC, post_id DESC LIMIT %s) t
+                           WHERE NOT EXISTS (SELECT 1 FROM app_hotpost h WHERE h.post_id = t.post_id)
+                           ''', [size])
+            cursor.execute('''
+                           DELETE FROM app_hotpost h USING app_post p
+                           WHERE h.post_id = p.post_id AND p.created_on < %s 
+                           AND h.post_id NOT IN (SELECT post_id FROM app_hotpost ORDER BY rank DESC, post_id DESC LIMIT %s)
+                           ''', [Post.get_cut_off(), size])
+            transaction.commit_unless_managed()
+        finally:
+            cursor.close()
+
+
+class HotWindow(models.Model):
+    """
+    Size of hot window, its only row is read by Post.hot_posts and triggers of db-scripts/hot_window.sql 
+    and set from HOT_WINDOW_SIZE by HotPost.refresh_window
+    """
+    size = models.IntegerField()
 
 
 class Subscription(models.Model):
@@ -1075,6 +1449,8 @@ class Subscription(models.Model):
         if cls.objects.filter(channel_id=channel_id, user=user).count() == 0:
             cls.objects.create(channel_id=channel_id, user=user, created_by=str(user))
             Channel.objects.filter(channel_id=channel_id).update(subscription_count=F('subscription_count') + 1)
+            cache.bump_version_on_commit('channels')
+            User.invalidate_sidebar(user.user_id)
     
     @classmethod
     def unsubscribe(cls, channel_id, user):        
@@ -1082,6 +1458,8 @@ class Subscription(models.Model):
             subscription = cls.objects.get(channel_id=channel_id, user=user)
             subscription.delete()
             Channel.objects.filter(channel_id=channel_id).update(subscription_count=F('subscription_count') - 1)
+            cache.bump_version_on_commit('channels')
+            User.invalidate_sidebar(user.user_id)
         except cls.DoesNotExist:
             pass
     
@@ -1119,6 +1497,8 @@ class Pin(models.Model):
         if not cls.objects.filter(tag=tag, user=user).exists():
             cls.objects.create(tag=tag, user=user, created_by=str(user))
             Tag.objects.filter(tag_id=tag.tag_id).update(pin_count=F('pin_count') + 1)
+            cache.bump_version_on_commit('tags')
+            User.invalidate_sidebar(user.user_id)
     
     @classmethod
     def unpin_tag(cls, tag_name, user):
@@ -1127,6 +1507,8 @@ class Pin(models.Model):
             pin_tag = cls.objects.get(tag__name__iexact=tag_name, user=user)
             pin_tag.delete()
             Tag.objects.filter(name__iexact=tag_name).update(pin_count=F('pin_count') - 1)
+            cache.bump_version_on_commit('tags')
+            User.invalidate_sidebar(user.user_id)
         except cls.DoesNotExist:
             pass             
     
@@ -1150,6 +1532,7 @@ class Comment(models.Model):
     reply_to = models.ForeignKey('self', null=True, blank=True)
     user = models.ForeignKey(User)
     comment_text = models.TextField()
+    comment_html = models.TextField(null=True, blank=True)
     votes = models.IntegerField(default=0)
     up_votes = models.IntegerField(default=0)
     down_votes = models.IntegerField(default=0)
@@ -1158,6 +1541,9 @@ class Comment(models.Model):
     is_muted = models.BooleanField(default=0)
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=75)
+    # sort_path double precision[] column is maintained by triggers of db-scripts/comment_sort_path.sql and read by raw queries
+    
+    _has_sort_paths = None
     
     def __unicode__(self):
         return self.comment_text[:50]
@@ -1177,6 +1563,23 @@ class Comment(models.Model):
         Returns absolute url of the comment
         """
         return ('app_comment', (self.post_id, self.post.slug, self.comment_id,))
+    
+    def save(self, *args, **kwargs):
+        """
+        Saves comment with html of its text, edits of saved comment (e.g. in admin) invalidate cached fragments of post
+        """
+        is_update = self.comment_id is not None
+        self.comment_html = markup.text_html(self.comment_text)
+        super(Comment, self).save(*args, **kwargs)
+        if is_update:
+            fragments.invalidate(self.post_id)
+    
+    @memoize.method
+    def get_comment_html(self):
+        """
+        Returns html of markdown comment text stored with comment or rendered for comments saved before it was stored
+        """
+        return mark_safe(self.comment_html if self.comment_html is not None else markup.text_html(self.comment_text) or '')
     
     @classmethod
     def save_comment(cls, user, post_id, slug, comment_text):
@@ -1185,8 +1588,10 @@ class Comment(models.Model):
         """
         if Post.objects.filter(post_id=post_id, slug=slug).update(comment_count=F('comment_count') + 1) == 1:
             User.objects.filter(user_id=user.user_id).update(comment_count=F('comment_count') + 1)
+            User.invalidate_cached(user.user_id)
             comment = cls.objects.create(post_id=post_id, user=user, comment_text=comment_text, created_by=str(user))
             Message.add_comment_msg(comment, user)
+            fragments.invalidate(post_id)
             return comment
 
     @classmethod
@@ -1196,10 +1601,147 @@ class Comment(models.Model):
         """
         if Post.objects.filter(post_id=post_id, slug=slug).update(comment_count=F('comment_count') + 1) == 1:
             User.objects.filter(user_id=user.user_id).update(comment_count=F('comment_count') + 1)
+            User.invalidate_cached(user.user_id)
             cls.objects.filter(comment_id=comment_id).update(reply_count=F('reply_count') + 1)
             comment = cls.objects.create(post_id=post_id, reply_to_id=comment_id, user=user, comment_text=comment_text, created_by=str(user))
             Message.add_reply_msg(comment, user)
+            fragments.invalidate(post_id)
             return comment
+    
+    @classmethod
+    def load_thread(cls, post, user, root_id=None, more=None, max_comments=200):
+        """
+        Returns comments of post as tree with replies limited by COMMENT_LEVEL_LIMITS, comments are read from post
+        root, from root_id comment or by more token of a comment which has more replies than already shown
+        """
+        parent_id = offset = 0
+        if more:
+            parent_id, offset = [long(value) for value in more.key]
+            start = 'c.reply_to_id = %s' if parent_id else 'c.reply_to_id IS NULL AND 0 = %s'
+            start_params = [parent_id]
+        elif root_id:
+            start, start_params = 'c.comment_id = %s', [root_id]
+        else:
+            start, start_params = 'c.reply_to_id IS NULL', []
+        
+        # Subtree is walked with ids only, then replies of each comment are ranked and cut by limit of their depth
+        limits = list(settings.COMMENT_LEVEL_LIMITS)
+        comments = list(cls.objects.raw('''
+                                        WITH RECURSIVE thread AS (
+                                            SELECT c.comment_id, c.reply_to_id, c.rank, 0 AS depth
+                                            FROM app_comment c
+                                            WHERE c.post_id = %s AND {start}
+                                            UNION ALL
+                                            SELECT c.comment_id, c.reply_to_id, c.rank, t.depth + 1
+                                            FROM app_comment c
+                                            JOIN thread t ON c.reply_to_id = t.comment_id
+                                            WHERE t.depth < %s
+                                        ), ranked AS (
+                                            SELECT t.comment_id, t.reply_to_id, t.depth,
+                                                   row_number() OVER (PARTITION BY t.depth, t.reply_to_id ORDER BY t.rank DESC, t.comment_id) AS position,
+                                                   count(*) OVER (PARTITION BY t.depth, t.reply_to_id) AS siblings
+                                            FROM thread t
+                                        ), visible AS (
+                                            SELECT r.* FROM ranked r
+                                            WHERE r.depth = 0 AND r.position > %s AND r.position <= %s + (%s::integer[])[1]
+                                            UNION ALL
+                                            SELECT r.* FROM ranked r
+                                            JOIN visible s ON r.reply_to_id = s.comment_id
+                                            WHERE r.position <= (%s::integer[])[r.depth + 1]
+                                        )
+                                        SELECT c.*, v.vote AS vote_index, s.depth, s.position, s.siblings
+                                        FROM visible s
+                                        JOIN app_comment c ON c.comment_id = s.comment_id
+                                        LEFT OUTER JOIN app_commentvote v ON c.comment_id = v.comment_id AND v.user_id = %s
+                                        ORDER BY s.depth, s.position
+                                        LIMIT %s
+                                        '''.format(start=start), [post.post_id] + start_params + [len(limits) - 1, offset, offset, limits, limits, user.user_id, max_comments]))
+        
+        roots = cls.build_tree(post, comments)
+        for comment in roots.loaded:
+            if comment.reply_count > len(comment.replies):
+                comment.more_token = paging.Cursor((comment.comment_id, len(comment.replies))).encode()
+        
+        roots.param = 'more'
+        if roots and not root_id and roots[0].siblings > offset + len(roots):
+            roots.next_cursor = paging.Cursor((parent_id, offset + len(roots))).encode()
+        
+        return roots
+    
+    @classmethod
+    def path_page(cls, post, user, after=None, max_comments=200):
+        """
+        Returns depth first page of comments of post after cursor of a sort path with one index range scan, replies
+        whose parent is on previous page are shown at top, sort paths are maintained by db-scripts/comment_sort_path.sql
+        """
+        comments = list(cls.objects.raw('''
+                                        SELECT c.*, v.vote AS vote_index
+                                        FROM app_comment c
+                                        LEFT OUTER JOIN app_commentvote v ON c.comment_id = v.comment_id AND v.user_id = %s
+                                        WHERE c.post_id = %s AND c.sort_path > %s::double precision[]
+                                        ORDER BY c.sort_path
+                                        LIMIT %s
+                                        ''', [user.user_id, post.post_id, list(after.key) if after else [], max_comments + 1]))
+        
+        roots = cls.build_tree(post, comments[:max_comments])
+        roots.param = 'after'
+        if len(comments) > max_comments:
+            roots.next_cursor = paging.Cursor(comments[max_comments - 1].sort_path).encode()
+        
+        return roots
+    
+    @staticmethod
+    def get_vote_counts(comment_ids):
+        """
+        Returns current votes of comments as dict of comment_id and votes
+        """
+        if not comment_ids:
+            return {}
+        
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''SELECT comment_id, votes FROM app_comment WHERE comment_id = ANY(%s)''', [list(comment_ids)])
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+    
+    @classmethod
+    def has_sort_paths(cls):
+        """
+        Returns True if sort_path column of db-scripts/comment_sort_path.sql exists, databases created by syncdb only 
+        don't have it. It's checked once in a process, so processes are restarted after running the script
+        """
+        if cls._has_sort_paths is None:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('''SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'app_comment' AND column_name = 'sort_path')''')
+                cls._has_sort_paths = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        
+        return cls._has_sort_paths
+    
+    @staticmethod
+    def build_tree(post, comments):
+        """
+        Returns top comments with replies attached in one pass, comments must come after their parent and comments
+        whose parent is not loaded are returned as top comments
+        """
+        roots = paging.Page()
+        tree = {}
+        for comment in comments:
+            comment.post = post
+            comment.replies = []
+            comment.more_token = None
+            if comment.reply_to_id in tree:
+                tree[comment.reply_to_id].replies.append(comment)
+            else:
+                roots.append(comment)
+            
+            tree[comment.comment_id] = comment
+        
+        roots.loaded = tree.values()
+        return roots
 
 
 
@@ -1211,80 +1753,93 @@ class PostVote(models.Model):
     post = models.ForeignKey(Post)
     user = models.ForeignKey(User)
     vote = models.IntegerField(default=0)
-    updated_on = models.DateTimeField(auto_now=True)
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
     updated_by = models.CharField(max_length=75)
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=75)
     
     class Meta:
         unique_together = ('post', 'user',)
+    
+    @staticmethod
+    def overlay(posts, user):
+        """
+        Sets vote_index of user on posts with a single query, so listings of posts can be shared among all users
+        """
+        votes = {}
+        if posts and user and user.is_authenticated():
+            cursor = connection.cursor()
+            try:
+                cursor.execute('''SELECT post_id, vote FROM app_postvote WHERE user_id = %s AND post_id = ANY(%s)''', [user.user_id, [post.post_id for post in posts]])
+                votes = dict(cursor.fetchall())
+            finally:
+                cursor.close()
+        
+        for post in posts:
+            post.vote_index = votes.get(post.post_id)
+        
+        return posts
     
-    @classmethod
-    def up_vote(cls, user, post_id):
-        """
-        Vote up if user not voted otherwise makes it zero
-        """
-        try:
-            post_vote = cls.objects.get(post_id=post_id, user_id=user.user_id)
-        except PostVote.DoesNotExist:
-            post_vote = cls.objects.create(post_id=post_id, user_id=user.user_id, updated_by=str(user), created_by=str(user))
-        
-        cursor = connection.cursor()
-        try:
-                  
-            if post_vote.vote == 0:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote=1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') + 1)
-                cursor.execute('''UPDATE app_post SET up_votes = up_votes + 1, votes = (up_votes - down_votes + 1), rank = compute_rank(up_votes - down_votes + 1, created_on) WHERE post_id = %s''', [post_id])
-                vote = [1, 1]
-            elif post_vote.vote > 0:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote=0, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') - 1)
-                cursor.execute('''UPDATE app_post SET up_votes = up_votes - 1, votes = (up_votes - down_votes - 1), rank = compute_rank(up_votes - down_votes - 1, created_on) WHERE post_id = %s''', [post_id])
-                vote = [0, -1]
-            else:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote=1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') + 1, down_votes=F('down_votes') - 1)
-                cursor.execute('''UPDATE app_post SET up_votes = up_votes + 1, down_votes = down_votes - 1, votes = (up_votes - down_votes + 2), rank = compute_rank(up_votes - down_votes + 2, created_on) WHERE post_id = %s''', [post_id])
-                vote = [1, 2]
-                
-            transaction.commit_unless_managed()
-            return vote            
-        finally:
-            cursor.close()        
-        
-     
-    @classmethod
-    def down_vote(cls, user, post_id):
-        """
-        Vote down if user not voted otherwise makes it zero
-        """
-        try:
-            post_vote = cls.objects.get(post_id=post_id, user_id=user.user_id)
-        except PostVote.DoesNotExist:
-            post_vote = cls.objects.create(post_id=post_id, user_id=user.user_id, updated_by=str(user), created_by=str(user))
+    @classmethod
+    def apply_vote(cls, user, post_id, vote):
+        """
+        Applies up (1) or down (-1) vote of user with one call of vote_post stored procedure (db-scripts/vote.sql), 
+        same vote again makes it zero, returns (vote_index, net_effect)
         
+        With VOTE_WRITE_BEHIND only vote of user is saved, post counters are updated by flush_counts
+        """
         cursor = connection.cursor()
         try:
-            
-            if post_vote.vote == 0:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote= -1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(down_votes=F('down_votes') + 1)     
-                cursor.execute('''UPDATE app_post SET down_votes = down_votes + 1, votes = (up_votes - down_votes - 1), rank = compute_rank(up_votes - down_votes - 1, created_on) WHERE post_id = %s''', [post_id])
-                vote = [-1, -1]
-            elif post_vote.vote > 0:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote= -1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') - 1, down_votes=F('down_votes') + 1)                
-                cursor.execute('''UPDATE app_post SET up_votes = up_votes - 1, down_votes = down_votes + 1, votes = (up_votes - down_votes - 2), rank = compute_rank(up_votes - down_votes - 2, created_on) WHERE post_id = %s''', [post_id])
-                vote = [-1, -2]
-            else:
-                cls.objects.filter(post_id=post_id, user_id=user.user_id).update(vote=0, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(down_votes=F('down_votes') - 1)   
-                cursor.execute('''UPDATE app_post SET down_votes = down_votes - 1, votes = (up_votes - down_votes + 1), rank = compute_rank(up_votes - down_votes + 1, created_on) WHERE post_id = %s''', [post_id])
-                vote = [0, 1]
-            
+            cursor.execute('''SELECT vote_index, net_effect FROM vote_post(%s, %s, %s, %s, %s)''', [post_id, user.user_id, vote, str(user), not settings.VOTE_WRITE_BEHIND])
+            vote_index, net_effect = cursor.fetchone()
+            transaction.commit_unless_managed()
+            User.invalidate_cached(user.user_id)
+            if not settings.VOTE_WRITE_BEHIND:
+                postindex.touch([post_id])
+            return vote_index, net_effect
+        finally:
+            cursor.close()
+    
+    @classmethod
+    def up_vote(cls, user, post_id):
+        """
+        Vote up if user not voted otherwise makes it zero
+        """
+        return cls.apply_vote(user, post_id, 1)
+    
+    @classmethod
+    def down_vote(cls, user, post_id):
+        """
+        Vote down if user not voted otherwise makes it zero
+        """
+        return cls.apply_vote(user, post_id, -1)
+    
+    @classmethod
+    def flush_counts(cls, since):
+        """
+        Recounts votes of posts voted after since from post votes and updates changed counters and ranks with one statement,
+        it is idempotent so votes can be flushed again after crash or with overlapping since. Returns number of updated posts
+        and database time of the flush, votes are stamped by database so next since is taken from it
+        """
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''
+                           WITH flushed AS (
+                           UPDATE app_post t SET up_votes = v.up_votes, down_votes = v.down_votes, votes = v.up_votes - v.down_votes,
+                                  rank = compute_rank(v.up_votes - v.down_votes, t.created_on)
+                           FROM (SELECT post_id, SUM(CASE WHEN vote > 0 THEN 1 ELSE 0 END)::integer AS up_votes, 
+                                        SUM(CASE WHEN vote < 0 THEN 1 ELSE 0 END)::integer AS down_votes
+                                 FROM app_postvote
+                                 WHERE post_id IN (SELECT DISTINCT post_id FROM app_postvote WHERE updated_on > %s)
+                                 GROUP BY post_id) v
+                           WHERE t.post_id = v.post_id AND (t.up_votes <> v.up_votes OR t.down_votes <> v.down_votes)
+                           RETURNING t.post_id)
+                           SELECT now(), ARRAY(SELECT post_id FROM flushed)
+                           ''', [since])
+            flushed_on, post_ids = cursor.fetchone()
             transaction.commit_unless_managed()
-            return vote
+            postindex.touch(post_ids)
+            return len(post_ids), flushed_on
         finally:
             cursor.close()
                         
@@ -1297,7 +1852,7 @@ class CommentVote(models.Model):
     comment = models.ForeignKey(Comment)
     user = models.ForeignKey(User)
     vote = models.IntegerField(default=0)
-    updated_on = models.DateTimeField(auto_now=True)
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
     updated_by = models.CharField(max_length=75)
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=75)
@@ -1305,72 +1860,83 @@ class CommentVote(models.Model):
     class Meta:
         unique_together = ('comment', 'user',)
     
-    @classmethod
-    def up_vote(cls, user, comment_id):
+    @staticmethod
+    def get_votes(user, post_id):
         """
-        Vote up if user not voted otherwise makes it zero
+        Returns votes of user on comments of post as dict of comment_id and vote
         """
+        if not user.is_authenticated():
+            return {}
+        
+        cursor = connection.cursor()
         try:
-            comment_vote = cls.objects.get(comment_id=comment_id, user_id=user.user_id)
-        except CommentVote.DoesNotExist:
-            comment_vote = cls.objects.create(comment_id=comment_id, user_id=user.user_id, updated_by=str(user), created_by=str(user))
+            cursor.execute('''
+                           SELECT v.comment_id, v.vote
+                           FROM app_commentvote v
+                           JOIN app_comment c ON v.comment_id = c.comment_id
+                           WHERE v.user_id = %s AND c.post_id = %s AND v.vote <> 0
+                           ''', [user.user_id, post_id])
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+    
+    @classmethod
+    def apply_vote(cls, user, comment_id, vote):
+        """
+        Applies up (1) or down (-1) vote of user with one call of vote_comment stored procedure (db-scripts/vote.sql), 
+        same vote again makes it zero, returns (vote_index, net_effect)
         
+        With VOTE_WRITE_BEHIND only vote of user is saved, comment counters are updated by flush_counts
+        """
         cursor = connection.cursor()
         try:
-                  
-            if comment_vote.vote == 0:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote=1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') + 1)
-                cursor.execute('''UPDATE app_comment SET up_votes = up_votes + 1, votes = (up_votes - down_votes + 1), rank = compute_rank(up_votes + 1, down_votes) WHERE comment_id = %s''', [comment_id])
-                vote = [1, 1]
-            elif comment_vote.vote > 0:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote=0, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') - 1)
-                cursor.execute('''UPDATE app_comment SET up_votes = up_votes - 1, votes = (up_votes - down_votes - 1), rank = compute_rank(up_votes - 1, down_votes) WHERE comment_id = %s''', [comment_id])
-                vote = [0, -1]
-            else:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote=1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') + 1, down_votes=F('down_votes') - 1)                
-                cursor.execute('''UPDATE app_comment SET up_votes = up_votes + 1, down_votes = down_votes - 1, votes = (up_votes - down_votes + 2), rank = compute_rank(up_votes + 1, down_votes - 1) WHERE comment_id = %s''', [comment_id])
-                vote = [1, 2]
-                
+            cursor.execute('''SELECT vote_index, net_effect FROM vote_comment(%s, %s, %s, %s, %s)''', [comment_id, user.user_id, vote, str(user), not settings.VOTE_WRITE_BEHIND])
+            vote_index, net_effect = cursor.fetchone()
             transaction.commit_unless_managed()
-            return vote            
+            User.invalidate_cached(user.user_id)
+            return vote_index, net_effect
         finally:
-            cursor.close()        
-        
-     
+            cursor.close()
+    
+    @classmethod
+    def up_vote(cls, user, comment_id):
+        """
+        Vote up if user not voted otherwise makes it zero
+        """
+        return cls.apply_vote(user, comment_id, 1)
+    
     @classmethod
     def down_vote(cls, user, comment_id):
         """
         Vote down if user not voted otherwise makes it zero
         """
-        try:
-            comment_vote = cls.objects.get(comment_id=comment_id, user_id=user.user_id)
-        except CommentVote.DoesNotExist:
-            comment_vote = cls.objects.create(comment_id=comment_id, user_id=user.user_id, updated_by=str(user), created_by=str(user))
-        
+        return cls.apply_vote(user, comment_id, -1)
+    
+    @classmethod
+    def flush_counts(cls, since):
+        """
+        Recounts votes of comments voted after since from comment votes and updates changed counters and ranks with one statement,
+        it is idempotent so votes can be flushed again after crash or with overlapping since. Returns number of updated comments
+        and database time of the flush, votes are stamped by database so next since is taken from it
+        """
         cursor = connection.cursor()
         try:
-            
-            if comment_vote.vote == 0:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote= -1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(down_votes=F('down_votes') + 1)
-                cursor.execute('''UPDATE app_comment SET down_votes = down_votes + 1, votes = (up_votes - down_votes - 1), rank = compute_rank(up_votes, down_votes + 1) WHERE comment_id = %s''', [comment_id])                
-                vote = [-1, -1]
-            elif comment_vote.vote > 0:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote= -1, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(up_votes=F('up_votes') - 1, down_votes=F('down_votes') + 1)
-                cursor.execute('''UPDATE app_comment SET up_votes = up_votes - 1, down_votes = down_votes + 1, votes = (up_votes - down_votes - 2), rank = compute_rank(up_votes - 1, down_votes + 1) WHERE comment_id = %s''', [comment_id])
-                vote = [-1, -2]
-            else:
-                cls.objects.filter(comment_id=comment_id, user_id=user.user_id).update(vote=0, updated_by=str(user))
-                User.objects.filter(user_id=user.user_id).update(down_votes=F('down_votes') - 1)
-                cursor.execute('''UPDATE app_comment SET down_votes = down_votes - 1, votes = (up_votes - down_votes + 1), rank = compute_rank(up_votes, down_votes - 1) WHERE comment_id = %s''', [comment_id])
-                vote = [0, 1]
-            
+            cursor.execute('''
+                           WITH flushed AS (
+                           UPDATE app_comment t SET up_votes = v.up_votes, down_votes = v.down_votes, votes = v.up_votes - v.down_votes,
+                                  rank = compute_rank(v.up_votes, v.down_votes)
+                           FROM (SELECT comment_id, SUM(CASE WHEN vote > 0 THEN 1 ELSE 0 END)::integer AS up_votes, 
+                                        SUM(CASE WHEN vote < 0 THEN 1 ELSE 0 END)::integer AS down_votes
+                                 FROM app_commentvote
+                                 WHERE comment_id IN (SELECT DISTINCT comment_id FROM app_commentvote WHERE updated_on > %s)
+                                 GROUP BY comment_id) v
+                           WHERE t.comment_id = v.comment_id AND (t.up_votes <> v.up_votes OR t.down_votes <> v.down_votes)
+                           RETURNING t.post_id)
+                           SELECT now(), ARRAY(SELECT post_id FROM flushed)
+                           ''', [since])
+            flushed_on, post_ids = cursor.fetchone()
             transaction.commit_unless_managed()
-            return vote
+            return len(post_ids), flushed_on
         finally:
             cursor.close()
 
@@ -1411,12 +1977,14 @@ class Message(models.Model):
         """
         post = Post.objects.get(post_id=comment.post_id)
         if post.user_id and post.user_id != comment.user_id:
-            return cls.objects.create(user_id=post.user_id,
-                                      post=post,
-                                      comment_msg=comment,
-                                      sender=user,
-                                      message_type='CO',
-                                      created_by=str(user))
+            message = cls.objects.create(user_id=post.user_id,
+                                         post=post,
+                                         comment_msg=comment,
+                                         sender=user,
+                                         message_type='CO',
+                                         created_by=str(user))
+            User.invalidate_sidebar(post.user_id)
+            return message
             
     
     @classmethod
@@ -1426,13 +1994,15 @@ class Message(models.Model):
         """
         comment = Comment.objects.get(comment_id=reply.reply_to_id) 
         if comment.user_id != reply.user_id:      
-            return cls.objects.create(user_id=comment.user_id,
-                                      post_id=comment.post_id,
-                                      comment=comment,
-                                      comment_msg=reply,
-                                      sender=user,
-                                      message_type='RE',
-                                      created_by=str(user))
+            message = cls.objects.create(user_id=comment.user_id,
+                                         post_id=comment.post_id,
+                                         comment=comment,
+                                         comment_msg=reply,
+                                         sender=user,
+                                         message_type='RE',
+                                         created_by=str(user))
+            User.invalidate_sidebar(comment.user_id)
+            return message
     
     @classmethod
     def get_messages(cls, user, max=20):
@@ -1459,6 +2029,8 @@ class Message(models.Model):
         else:
             cls.objects.filter(message_id=msg_id, user=user, read_on__isnull=True).update(read_on=now)
         
+        User.invalidate_sidebar(user.user_id)
+        
     @classmethod
     def mark_viewed(cls, msg_id, user):
         """
@@ -1466,6 +2038,7 @@ class Message(models.Model):
         """
         now = datetime.datetime.now()
         cls.objects.filter(message_id__lte=msg_id, user=user, viewed_on__isnull=True).update(viewed_on=now)
+        User.invalidate_sidebar(user.user_id)
 
 
 class FbUser(models.Model):
@@ -1508,6 +2081,7 @@ class FbUser(models.Model):
                                email=email,
                                access_token=access_token,
                                access_expiry=access_expiry)
+            User.invalidate_cached(user.user_id)
             return True
     
     @classmethod
@@ -1536,6 +2110,7 @@ class FbUser(models.Model):
                                email=email,
                                access_token=access_token,
                                access_expiry=access_expiry)
+            User.invalidate_cached(user.user_id)
             return True, user
     
 
@@ -1565,9 +2140,12 @@ class FlashMessage(models.Model):
     @classmethod
     def add_message(cls, flash_type, flash_text, user):
         """
-        Adds a new message for user in database
+        Adds a new message for user in database, flag of pending messages is set after commit so get_messages of
+        concurrent request can't clear it before message is visible
         """
-        return cls.objects.create(flash_type=flash_type, flash_text=flash_text, user=user, created_by=str(user))
+        message = cls.objects.create(flash_type=flash_type, flash_text=flash_text, user=user, created_by=str(user))
+        cache.after_commit(cache.set_value, 'flash:%s' % user.user_id, True)
+        return message
     
     @classmethod
     def add_info(cls, flash_text, user):
@@ -1600,8 +2178,12 @@ class FlashMessage(models.Model):
     @classmethod
     def peek_messages(cls, user):
         """
-        Returns all flash messages for user but don't delete them in database
-        """        
+        Returns all flash messages for user but don't delete them in database, database is not read if cache knows
+        that user has no messages
+        """
+        if cache.get_value('flash:%s' % user.user_id) is False:
+            return []
+        
         return [flash for flash in cls.objects.filter(user=user).order_by('flash_id')]
 
     @classmethod
@@ -1609,7 +2191,14 @@ class FlashMessage(models.Model):
         """
         Returns all flash messages for user and delete them database
         """
-        messages = cls.peek_messages(user)        
-        cls.objects.filter(user=user).delete()
+        if cache.get_value('flash:%s' % user.user_id) is False:
+            return []
+        
+        # Clearing flag before reading, so message added meanwhile sets it again
+        cache.set_value('flash:%s' % user.user_id, False)
+        messages = [flash for flash in cls.objects.filter(user=user).order_by('flash_id')]
+        if messages:
+            cls.objects.filter(flash_id__lte=messages[-1].flash_id, user=user).delete()
+        
         return messages
 
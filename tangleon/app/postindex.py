@@ -0,0 +1,315 @@
+"""
+In-memory index of post ids sorted by rank and by post id per listing, served to web workers over a local socket
+
+Protocol is one JSON object per line for request and response:
+    {"op": "page", "listing": "posts", "order": "top", "after": [rank, post_id], "offset": 0, "size": 21}
+        => {"posts": [[rank, post_id], ...]}, ranks are those of index, cursors of next pages must be built from them
+    {"op": "touch", "ids": [post_id, ...]} => {"ok": true}, posts are reloaded from database shortly after
+    {"op": "rebuild"} => {"ok": true}, all posts are reloaded from database
+"""
+
+import json
+import time
+import bisect
+import socket
+import logging
+import threading
+import SocketServer
+
+from django.db import connection, close_old_connections
+
+from tangleon import settings
+
+logger = logging.getLogger(__name__)
+
+
+def listing_keys(channel_id, has_image, tags):
+    """
+    Returns keys of listings a post belongs to, same as listings of Post.get_posts, channel_posts and tagged_posts
+    """
+    keys = ['posts']
+    if has_image:
+        keys.append('posts:image')
+    
+    if channel_id:
+        keys.append('channel:%s' % channel_id)
+    
+    keys.extend('tag:%s' % tag for tag in sorted(set(tag.lower() for tag in (tags or '').split(',') if tag)))
+    return keys
+
+
+class Listing(object):
+    """
+    Post ids of a listing in descending order of (rank, post_id) and of post_id, kept as negated ascending lists
+    """
+    def __init__(self):
+        self.top = []
+        self.new = []
+    
+    def add(self, post_id, rank):
+        bisect.insort(self.top, (-rank, -post_id))
+        bisect.insort(self.new, -post_id)
+    
+    def remove(self, post_id, rank):
+        index = bisect.bisect_left(self.top, (-rank, -post_id))
+        if index < len(self.top) and self.top[index] == (-rank, -post_id):
+            del self.top[index]
+        
+        index = bisect.bisect_left(self.new, -post_id)
+        if index < len(self.new) and self.new[index] == -post_id:
+            del self.new[index]
+    
+    def sort(self):
+        self.top.sort()
+        self.new.sort()
+    
+    def page(self, order, after, offset, size):
+        """
+        Returns post ids after sort key of a post or from offset
+        """
+        if order == 'top':
+            start = bisect.bisect_right(self.top, (-after[0], -after[1])) if after else offset
+            return [-post_id for rank, post_id in self.top[start:start + size]]
+        
+        start = bisect.bisect_right(self.new, -after[0]) if after else offset
+        return [-post_id for post_id in self.new[start:start + size]]
+
+
+class PostIndex(object):
+    """
+    Listings of all not muted posts
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.posts = {}
+        self.is_ready = False
+    
+    def page(self, listing, order, after, offset, size):
+        """
+        Returns (rank, post_id) of posts of page, None until index is built
+        """
+        with self.lock:
+            if not self.is_ready:
+                return None
+            
+            post_ids = self.listings[listing].page(order, after, offset, size) if listing in self.listings else []
+            return [(self.posts[post_id][0], post_id) for post_id in post_ids]
+    
+    def put(self, post_id, rank, keys):
+        with self.lock:
+            self._remove(post_id)
+            self.posts[post_id] = (rank, keys)
+            for key in keys:
+                self.listings.setdefault(key, Listing()).add(post_id, rank)
+    
+    def remove(self, post_id):
+        with self.lock:
+            self._remove(post_id)
+    
+    def _remove(self, post_id):
+        if post_id in self.posts:
+            rank, keys = self.posts.pop(post_id)
+            for key in keys:
+                self.listings[key].remove(post_id, rank)
+    
+    def load(self, post_ids):
+        """
+        Reloads posts from database
+        """
+        found = set()
+        for post_id, rank, channel_id, has_image, tags, is_muted in self.read_posts('WHERE post_id = ANY(%s)', [list(post_ids)]):
+            found.add(post_id)
+            if is_muted:
+                self.remove(post_id)
+            else:
+                self.put(post_id, rank, listing_keys(channel_id, has_image, tags))
+        
+        # Removing deleted posts
+        for post_id in set(post_ids) - found:
+            self.remove(post_id)
+    
+    def rebuild(self, chunk_size=50000):
+        """
+        Reads all posts from database into new listings and swaps them with current listings
+        """
+        listings = {}
+        posts = {}
+        last_post_id = 0
+        while True:
+            rows = self.read_posts('WHERE post_id > %s AND is_muted = False ORDER BY post_id LIMIT %s', [last_post_id, chunk_size])
+            if not rows:
+                break
+            
+            for post_id, rank, channel_id, has_image, tags, is_muted in rows:
+                keys = listing_keys(channel_id, has_image, tags)
+                posts[post_id] = (rank, keys)
+                for key in keys:
+                    listing = listings.setdefault(key, Listing())
+                    listing.top.append((-rank, -post_id))
+                    listing.new.append(-post_id)
+            
+            last_post_id = rows[-1][0]
+        
+        for listing in listings.values():
+            listing.sort()
+        
+        with self.lock:
+            self.listings = listings
+            self.posts = posts
+            self.is_ready = True
+    
+    @staticmethod
+    def read_posts(condition, params):
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT post_id, rank, channel_id, img_url IS NOT NULL, tags, is_muted FROM app_post ' + condition, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            message = json.loads(line)
+            op = message.get('op')
+            if op == 'page':
+                after = message.get('after')
+                response = {'posts': self.server.index.page(message['listing'], message.get('order', 'top'), after,
+                                                            int(message.get('offset', 0)), int(message['size']))}
+            elif op == 'touch':
+                self.server.touch(int(post_id) for post_id in message['ids'])
+                response = {'ok': True}
+            elif op == 'rebuild':
+                self.server.touch(None)
+                response = {'ok': True}
+            else:
+                response = {'error': 'Unknown operation'}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {'error': str(e)}
+        
+        try:
+            self.wfile.write(json.dumps(response) + '\n')
+        except socket.error:
+            # Clients of notify don't wait for response
+            pass
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves post index on unix socket, touched posts are reloaded by a loader thread so requests never wait for database
+    """
+    daemon_threads = True
+    
+    def __init__(self, path, rebuild_interval=3600):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.index = PostIndex()
+        self.rebuild_interval = rebuild_interval
+        self.pending = set()
+        self.rebuild_on = 0
+        self.changed = threading.Condition()
+    
+    def touch(self, post_ids):
+        """
+        Queues posts for reload, None queues rebuild of whole index
+        """
+        with self.changed:
+            if post_ids is None:
+                self.rebuild_on = 0
+            else:
+                self.pending.update(post_ids)
+            self.changed.notify()
+    
+    def load(self):
+        while True:
+            with self.changed:
+                if not self.pending and time.time() < self.rebuild_on:
+                    self.changed.wait(1)
+                
+                post_ids, self.pending = self.pending, set()
+                rebuild = time.time() >= self.rebuild_on
+                if rebuild:
+                    self.rebuild_on = time.time() + self.rebuild_interval
+            
+            try:
+                if rebuild:
+                    self.index.rebuild()
+                    logger.info('Post index is rebuilt with %s posts', len(self.index.posts))
+                
+                if post_ids:
+                    self.index.load(post_ids)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                close_old_connections()
+    
+    def run(self):
+        loader = threading.Thread(target=self.load, name='post-index-loader')
+        loader.daemon = True
+        loader.start()
+        self.serve_forever()
+
+
+def request(message):
+    """
+    Sends message to post index and returns its response, None if index is not configured or doesn't respond
+    """
+    if not settings.POST_INDEX_SOCKET:
+        return None
+    
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(settings.POST_INDEX_TIMEOUT)
+        try:
+            client.connect(settings.POST_INDEX_SOCKET)
+            client.sendall(json.dumps(message) + '\n')
+            response = client.makefile().readline()
+        finally:
+            client.close()
+        
+        return json.loads(response) if response else None
+    except (socket.error, ValueError):
+        return None
+
+
+def notify(message):
+    """
+    Sends message to post index without waiting for it, message is dropped if index is not configured, not running or busy
+    """
+    if not settings.POST_INDEX_SOCKET:
+        return
+    
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.setblocking(False)
+    try:
+        client.connect(settings.POST_INDEX_SOCKET)
+        client.sendall(json.dumps(message) + '\n')
+    except socket.error:
+        pass
+    finally:
+        client.close()
+
+
+def page_ids(listing, sort_by_new, cursor, page_index, page_size, size):
+    """
+    Returns up to size (rank, post_id) of posts of listing from start of page, None if index can't serve the page,
+    ranks of index may differ from ranks in database until index reloads touched posts
+    """
+    if cursor and cursor.backward:
+        return None
+    
+    response = request({'op': 'page', 'listing': listing, 'order': 'new' if sort_by_new else 'top',
+                        'after': list(cursor.key) if cursor else None, 'offset': page_index * page_size, 'size': size})
+    posts = response.get('posts') if response else None
+    return [tuple(post) for post in posts] if posts is not None else None
+
+
+def touch(post_ids):
+    """
+    Notifies post index about new or changed posts, it doesn't wait for index so votes and submits aren't slowed down
+    """
+    post_ids = list(post_ids)
+    if post_ids:
+        notify({'op': 'touch', 'ids': post_ids})
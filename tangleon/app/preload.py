@@ -0,0 +1,44 @@
+"""
+Compiling all TangleOn templates into cached template loader at worker start
+"""
+
+import os
+import logging
+
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+from django.template.loaders.app_directories import app_template_dirs
+
+from tangleon import settings
+
+logger = logging.getLogger(__name__)
+
+
+def template_names():
+    """
+    Returns names of templates in TEMPLATE_DIRS and in template directories of TangleOn apps
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    dirs = list(settings.TEMPLATE_DIRS) + [path for path in app_template_dirs if os.path.abspath(path).startswith(root)]
+    names = set()
+    for template_dir in dirs:
+        for dir_path, dir_names, file_names in os.walk(template_dir):
+            for file_name in file_names:
+                names.add(os.path.relpath(os.path.join(dir_path, file_name), template_dir).replace(os.sep, '/'))
+    
+    return sorted(names)
+
+
+def preload_templates():
+    """
+    Loads all templates with template loaders of settings, returns number of loaded templates
+    """
+    count = 0
+    for name in template_names():
+        try:
+            get_template(name)
+            count += 1
+        except (TemplateDoesNotExist, TemplateSyntaxError) as e:
+            logger.warning('Template %s is not preloaded: %s', name, e)
+    
+    return count
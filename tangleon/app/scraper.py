@@ -5,13 +5,16 @@ Utility methods for TangleOn
 """
 
 import re
+import Queue
+import contextlib
 import urllib
 import urllib2
 import httplib
 import urlparse
+import threading
 import HTMLParser
 
-from tangleon import TangleOnError
+from tangleon import settings, TangleOnError
 
 META_REGEX = r'''<meta[^>]*(?:property\s*=\s*"\s*{property}\s*"[^>]*content\s*=\s*(?:'|")([^"\r\n]+)(?:'|")[^>]*|content\s*=\s*(?:'|")([^"\r\n]+)(?:'|")[^>]*property\s*=\s*"\s*{property}\s*"[^>]*)>'''
 LINK_REGEX = r'''<link[^>]*(?:rel\s*=\s*"[^"]*{rel}[^"]*"[^>]*href\s*=\s*"([^"\r\n]+)"[^>]*|href\s*=\s*"([^"\r\n]+)"[^>]*rel\s*=\s*"[^"]*{rel}[^"]*"[^>]*)>'''
@@ -32,6 +35,11 @@ LINK_VIDEO_SRC_REGEX = re.compile(LINK_REGEX.format(rel='video_src'), re.IGNOREC
 LINK_VIDEO_TYPE_REGEX = re.compile(LINK_REGEX.format(rel='video_type'), re.IGNORECASE)
 HTML_PARSER = HTMLParser.HTMLParser()
 
+# Limits of concurrent page fetches shared by all MediaTags of the process, hosts are hashed into fixed 
+# number of host slots so long running sync process doesn't keep a semaphore for every host it has seen
+FETCH_SLOTS = threading.BoundedSemaphore(settings.SCRAPER_WORKERS)
+HOST_SLOTS = [threading.BoundedSemaphore(settings.SCRAPER_HOST_WORKERS) for i in range(64)]
+
 def get_page_title(url):
     """
     Returns page title from og:title meta tag or title tag
@@ -51,13 +59,13 @@ def get_page_title(url):
     raise TangleOnError('Page title doesn\'t exists in the web page.') 
 
 
-def get_media_tags(url):
+def get_media_tags(url, timeout=None):
     """
     Returns dict of image and video urls if defined for page in meta tags
     
     tags => image, video, video_type
     """
-    content_type, content = get_page_content(url)
+    content_type, content = get_page_content(url, timeout)
     
     tags = {}
     
@@ -94,6 +102,86 @@ def get_media_tags(url):
     return tags
 
 
+class MediaTags(object):
+    """
+    Media tags of pages fetched concurrently, with at most SCRAPER_WORKERS fetches in the process 
+    and SCRAPER_HOST_WORKERS fetches per host
+    """
+    def __init__(self, urls, timeout=None):
+        self.timeout = timeout or settings.SCRAPER_TIMEOUT
+        self.results = {}
+        self.pending = Queue.Queue()
+        
+        urls = set(url for url in urls if url)
+        for url in urls:
+            self.pending.put(url)
+        
+        workers = [threading.Thread(target=self.fetch) for i in range(min(len(urls), settings.SCRAPER_WORKERS))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        
+        for worker in workers:
+            worker.join()
+    
+    def fetch(self):
+        while True:
+            try:
+                url = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            
+            with fetch_slots(url):
+                try:
+                    self.results[url] = get_media_tags(url, self.timeout)
+                except Exception as e:
+                    self.results[url] = e
+    
+    def get_media_tags(self, url):
+        """
+        Returns media tags of fetched page or raises error occurred while fetching it, 
+        pages not given to constructor are fetched now
+        """
+        if url not in self.results:
+            return get_media_tags(url, self.timeout)
+        
+        result = self.results[url]
+        if isinstance(result, Exception):
+            raise result
+        
+        return dict(result)
+
+
+def get_host_slot(url):
+    """
+    Returns semaphore limiting concurrent fetches from host of url, shared with hosts hashed to the same slot
+    """
+    return HOST_SLOTS[hash(urlparse.urlparse(url).netloc.lower()) % len(HOST_SLOTS)]
+
+
+@contextlib.contextmanager
+def fetch_slots(url):
+    """
+    Holds a fetch slot of process and a slot of host of url, fetch slot is not held while waiting for host slot 
+    so pages of other hosts are fetched meanwhile
+    """
+    host_slot = get_host_slot(url)
+    while True:
+        FETCH_SLOTS.acquire()
+        if host_slot.acquire(False):
+            break
+        
+        FETCH_SLOTS.release()
+        with host_slot:
+            pass
+    
+    try:
+        yield
+    finally:
+        host_slot.release()
+        FETCH_SLOTS.release()
+
+
 def get_icon_url_and_description(link, feed):
     """
     Return icon url and description if found on the link
@@ -115,15 +203,15 @@ def get_icon_url_and_description(link, feed):
     return icon_url, description
 
 
-def get_page_content(url):
+def get_page_content(url, timeout=None):
     """
-    Returns page content on specified url
+    Returns page content on specified url, timeout in seconds applies to connecting and each read
     """
     request = urllib2.Request(url)
     request.add_header('User-Agent', 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:24.0) tangleon.com +(mailto:hi@tangleon.com)')
     
     try:
-        response = urllib2.urlopen(request)
+        response = urllib2.urlopen(request, timeout=timeout) if timeout else urllib2.urlopen(request)
         try:
             content_type = response.info().type
             if content_type.startswith('text/'):
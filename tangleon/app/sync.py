@@ -0,0 +1,82 @@
+"""
+Scheduler keeping RSS channels in sync with a bounded pool of worker threads
+"""
+
+import time
+import heapq
+import Queue
+import datetime
+import logging
+import threading
+
+from django.db import close_old_connections
+
+from tangleon import settings
+from tangleon.app.models import Channel
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Keeps priority queue of channels by sync due time and hands due channels to workers,
+    a channel is synced only by the process which claims it in database
+    """
+    def __init__(self, workers=None, reload_interval=300, user='sync_channels'):
+        self.workers = workers or settings.SYNC_WORKERS
+        self.reload_interval = reload_interval
+        self.user = user
+        self.interval = datetime.timedelta(minutes=settings.SYNC_INTERVAL)
+        self.tasks = Queue.Queue(maxsize=self.workers)
+        self.due = []
+        self.reload_on = None
+    
+    def start(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.work, name='sync-worker-%s' % i)
+            worker.daemon = True
+            worker.start()
+    
+    def work(self):
+        while True:
+            channel_id = self.tasks.get()
+            try:
+                Channel.objects.get(channel_id=channel_id).sync_channel(self.user)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                close_old_connections()
+                self.tasks.task_done()
+    
+    def reload(self, now):
+        """
+        Rebuilds queue from database to pick up new channels and channels synced by other processes
+        """
+        self.due = Channel.due_channels()
+        heapq.heapify(self.due)
+        self.reload_on = now + datetime.timedelta(seconds=self.reload_interval)
+    
+    def schedule(self, now):
+        """
+        Hands all due channels to workers, blocks while all workers are busy
+        """
+        if self.reload_on is None or now >= self.reload_on:
+            self.reload(now)
+        
+        while self.due and self.due[0][0] <= now:
+            due_on, channel_id = heapq.heappop(self.due)
+            if Channel.claim_sync(channel_id, now):
+                self.tasks.put(channel_id)
+            heapq.heappush(self.due, (now + self.interval, channel_id))
+    
+    def run(self, once=False):
+        self.start()
+        while True:
+            self.schedule(datetime.datetime.now())
+            if once:
+                self.tasks.join()
+                return
+            
+            now = datetime.datetime.now()
+            wake_on = min(self.reload_on, self.due[0][0]) if self.due else self.reload_on
+            time.sleep(min(max((wake_on - now).total_seconds(), 1), 60))
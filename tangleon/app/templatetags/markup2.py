@@ -3,17 +3,17 @@ Text to Markup filters
 """
 
 
-import markdown2 as md2
 from django import template
 from django.template.defaultfilters import stringfilter
-from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 
+from tangleon.app import markup
+
 register = template.Library()
 
 @register.filter(is_safe=True)
 @stringfilter
 def markdown2(value):
-    return mark_safe(md2.markdown(force_unicode(value)))
+    return mark_safe(markup.markdown(value))
 
 #register.filter(md2_to_html, 'md2_to_html')
\ No newline at end of file
@@ -5,7 +5,68 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import time
+import base64
+import random
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import unittest
+import threading
+
+from django.db import connection
+from django.contrib import admin
+from django.contrib.auth import models as auth_models
+from django.template import Template, Context
+from django.test import TestCase, SimpleTestCase
+from django.test.client import RequestFactory
+
+from tangleon import paging, rank, settings, cache
+from tangleon.app import postindex, fragments, markup, AnonymousUser
+from tangleon.app.models import User, Post, Tag, PostTag, HotPost, HotWindow, Comment, PostVote, Channel, FlashMessage
+
+requires_postgresql = unittest.skipUnless(connection.vendor == 'postgresql', 'Database is not PostgreSQL')
+
+
+def create_post(**fields):
+    """
+    Saves post with required fields filled in
+    """
+    values = {'guid': 0, 'title': 'Post', 'slug': 'post', 'link': 'http://www.tangleon.com', 
+              'published': datetime.datetime.now(), 'updated_by': 'test', 'created_by': 'test'}
+    values.update(fields)
+    return Post.objects.create(**values)
+
+
+def page_ids(listing):
+    """
+    Returns post ids of all pages of listing, it's called with cursor of next page
+    """
+    post_ids = []
+    cursor = None
+    for _ in range(100):
+        posts = listing(cursor)
+        post_ids.extend(post.post_id for post in posts)
+        if not posts.next_cursor:
+            return post_ids
+        
+        cursor = paging.Cursor.decode(posts.next_cursor)
+    
+    raise AssertionError('Listing has more than 100 pages, cursors may repeat pages')
+
+
+def run_script(name):
+    """
+    Runs script of db-scripts on test database
+    """
+    with open(os.path.join(os.path.dirname(__file__), '..', '..', 'db-scripts', name)) as script:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(script.read())
+        finally:
+            cursor.close()
 
 
 class SimpleTest(TestCase):
@@ -14,3 +75,529 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class PagingTest(SimpleTestCase):
+    class Row(object):
+        def __init__(self, rank, post_id):
+            self.rank = rank
+            self.post_id = post_id
+    
+    keyset = paging.Keyset(('p.rank', 'p.post_id'), ('rank', 'post_id'))
+    
+    def test_cursor_round_trip(self):
+        cursor = paging.Cursor.decode(paging.Cursor((1234.5678901, 42L), True).encode())
+        self.assertEqual(cursor.key, (1234.5678901, 42L))
+        self.assertTrue(cursor.backward)
+    
+    def test_invalid_cursor(self):
+        self.assertIsNone(paging.Cursor.decode('not a cursor!'))
+        self.assertIsNone(paging.Cursor.decode(''))
+        self.assertIsNone(self.keyset.fit(paging.Cursor((42L,))))
+    
+    def test_seek(self):
+        self.assertEqual(self.keyset.seek(None), ('', 'p.rank DESC, p.post_id DESC', []))
+        self.assertEqual(self.keyset.seek(paging.Cursor((2.5, 7L))), ('AND (p.rank, p.post_id) < (%s, %s)', 'p.rank DESC, p.post_id DESC', [2.5, 7L]))
+        self.assertEqual(self.keyset.seek(paging.Cursor((2.5, 7L), True)), ('AND (p.rank, p.post_id) > (%s, %s)', 'p.rank ASC, p.post_id ASC', [2.5, 7L]))
+    
+    def test_page(self):
+        rows = [self.Row(10.0 - i, 100L - i) for i in range(4)]
+        page = self.keyset.page(rows, 3)
+        self.assertEqual([row.post_id for row in page], [100, 99, 98])
+        self.assertEqual(paging.Cursor.decode(page.next_cursor).key, (8.0, 98L))
+        self.assertIsNone(page.prev_cursor)
+        
+        # Backward pages are fetched in ascending order
+        page = self.keyset.page(list(reversed(rows)), 3, paging.Cursor((6.0, 96L), True))
+        self.assertEqual([row.post_id for row in page], [99, 98, 97])
+        self.assertIsNotNone(page.prev_cursor)
+        self.assertEqual(paging.Cursor.decode(page.next_cursor).key, (7.0, 97L))
+
+
+@unittest.skipIf(rank.numpy is None, 'NumPy is not installed')
+class RankArrayTest(SimpleTestCase):
+    def test_hot_array(self):
+        rnd = random.Random(42)
+        votes = [rnd.choice([0, 1, -1, rnd.randint(-5000, 5000)]) for i in range(2000)]
+        dates = [datetime.datetime(2005, 1, 1) + datetime.timedelta(seconds=rnd.randint(0, 700000000), microseconds=rnd.randint(0, 999999)) for i in range(2000)]
+        self.assertEqual(rank.hot_array(votes, dates).tolist(), [rank.hot(v, d) for v, d in zip(votes, dates)])
+        self.assertEqual(rank.hot_array(votes, [rank.epoch_seconds(d) for d in dates]).tolist(), [rank.hot(v, d) for v, d in zip(votes, dates)])
+    
+    def test_rating_array(self):
+        rnd = random.Random(42)
+        ups = [0] + [rnd.randint(0, 3000) for i in range(2000)]
+        downs = [0] + [rnd.choice([0, rnd.randint(0, 3000)]) for i in range(2000)]
+        self.assertEqual(rank.rating_array(ups, downs).tolist(), [rank.rating(u, d) for u, d in zip(ups, downs)])
+    
+    def test_round_array(self):
+        # Multiples of 1/256 have exact halves at 7th and 1st decimal
+        values = [k / 256.0 for k in range(-3000, 3000)] + [0.5, 2.5, -1e-9, 1e17]
+        self.assertEqual(rank.round_array(values, 7).tolist(), [round(v, 7) for v in values])
+        self.assertEqual(rank.round_array(values, 1).tolist(), [round(v, 1) for v in values])
+
+
+class RankSqlTest(SimpleTestCase):
+    """
+    Differential test of SQL expressions generated from tangleon.rank against Python functions, run on SQLite
+    """
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE post (votes INTEGER, seconds REAL, up_votes INTEGER, down_votes INTEGER)')
+        self.rnd = random.Random(15)
+    
+    def tearDown(self):
+        self.db.close()
+    
+    def test_hot_sql(self):
+        rows = []
+        for i in range(5000):
+            date = datetime.datetime(2005, 1, 1) + datetime.timedelta(seconds=self.rnd.randint(0, 700000000), microseconds=self.rnd.randint(0, 999999))
+            rows.append((self.rnd.choice([0, 1, -1, self.rnd.randint(-5000, 5000)]), date))
+        
+        self.db.executemany('INSERT INTO post (votes, seconds) VALUES (?, ?)', [(votes, rank.epoch_seconds(date)) for votes, date in rows])
+        ranks = [r for r, in self.db.execute('SELECT %s FROM post ORDER BY rowid' % rank.hot_sql('votes', 'seconds', 'sqlite'))]
+        self.assertEqual(ranks, [rank.hot(votes, date) for votes, date in rows])
+    
+    def test_round_digits_sql(self):
+        # Multiples of 1/256 have exact halves at 7th and 1st decimal
+        values = [k / 256.0 for k in range(-3000, 3000)] + [0.0, 2.5, -1e-9, 1e9 / 3, 8521.52837015]
+        self.db.executemany('INSERT INTO post (seconds) VALUES (?)', [(value,) for value in values])
+        for ndigits in (1, 7):
+            rounded = [r for r, in self.db.execute('SELECT %s FROM post ORDER BY rowid' % rank.round_digits_sql('seconds', ndigits, 'sqlite'))]
+            self.assertEqual(rounded, [rank.round_digits(value, ndigits) for value in values])
+    
+    def test_rating_sql(self):
+        rows = [(0, 0), (1, 0), (0, 1)] + [(self.rnd.randint(0, 3000), self.rnd.choice([0, self.rnd.randint(0, 3000)])) for i in range(5000)]
+        self.db.executemany('INSERT INTO post (up_votes, down_votes) VALUES (?, ?)', rows)
+        ratings = [r for r, in self.db.execute('SELECT %s FROM post ORDER BY rowid' % rank.rating_sql('up_votes', 'down_votes', 'sqlite'))]
+        self.assertEqual(ratings, [rank.rating(ups, downs) for ups, downs in rows])
+    
+    def test_compute_rank_script(self):
+        path = os.path.join(os.path.dirname(__file__), '..', '..', 'db-scripts', 'compute_rank.sql')
+        with open(path) as script:
+            self.assertEqual(script.read(), rank.sql_functions(), 'Run "python manage.py rank_sql > db-scripts/compute_rank.sql"')
+
+
+@requires_postgresql
+class RankPostgresqlTest(TestCase):
+    """
+    Differential test of generated PostgreSQL expressions and compute_rank functions against Python functions
+    """
+    def setUp(self):
+        self.rnd = random.Random(15)
+        self.cursor = connection.cursor()
+    
+    def tearDown(self):
+        self.cursor.close()
+    
+    def random_posts(self, count):
+        votes = [self.rnd.choice([0, 1, -1, self.rnd.randint(-5000, 5000)]) for i in range(count)]
+        dates = [datetime.datetime(2005, 1, 1) + datetime.timedelta(seconds=self.rnd.randint(0, 700000000), microseconds=self.rnd.randint(0, 999999)) for i in range(count)]
+        return votes, dates
+    
+    def test_hot_sql(self):
+        votes, dates = self.random_posts(20000)
+        self.cursor.execute('SELECT %s FROM unnest(%%s::integer[], %%s::double precision[]) WITH ORDINALITY AS t(votes, seconds, i) ORDER BY i' 
+                            % rank.hot_sql('votes', 'seconds'), [votes, [rank.epoch_seconds(date) for date in dates]])
+        self.assertEqual([r for r, in self.cursor.fetchall()], [rank.hot(v, d) for v, d in zip(votes, dates)])
+    
+    def test_compute_rank(self):
+        self.cursor.execute(rank.sql_functions())
+        votes, dates = self.random_posts(20000)
+        self.cursor.execute('SELECT compute_rank(votes, post_date) FROM unnest(%s::integer[], %s::timestamp[]) WITH ORDINALITY AS t(votes, post_date, i) ORDER BY i', [votes, dates])
+        self.assertEqual([r for r, in self.cursor.fetchall()], [rank.hot(v, d) for v, d in zip(votes, dates)])
+        
+        ups = [0, 1, 0] + [self.rnd.randint(0, 3000) for i in range(5000)]
+        downs = [0, 0, 1] + [self.rnd.choice([0, self.rnd.randint(0, 3000)]) for i in range(5000)]
+        self.cursor.execute('SELECT compute_rank(ups, downs) FROM unnest(%s::integer[], %s::integer[]) WITH ORDINALITY AS t(ups, downs, i) ORDER BY i', [ups, downs])
+        self.assertEqual([r for r, in self.cursor.fetchall()], [rank.rating(u, d) for u, d in zip(ups, downs)])
+
+
+@requires_postgresql
+class HotWindowTest(TestCase):
+    def setUp(self):
+        run_script('hot_window.sql')
+        HotWindow.objects.create(size=3)
+        self.posts = dict((r, create_post(rank=float(r))) for r in range(1, 11))
+        
+        # Window of old posts left by compute_ranks, every post ranked above its 3rd post (8) is in it
+        HotPost.objects.exclude(post_id__in=[self.posts[r].post_id for r in (10, 9, 8, 4)]).delete()
+    
+    def top_ids(self, page_size):
+        return page_ids(lambda cursor: Post.get_posts(0, page_size, False, None, cursor=cursor))
+    
+    def expected_ids(self):
+        return list(Post.objects.order_by('-rank', '-post_id').values_list('post_id', flat=True))
+    
+    def test_down_vote(self):
+        # Threshold drops to 4 and posts ranked 5 to 7 must be pulled into window
+        Post.objects.filter(post_id=self.posts[10].post_id).update(rank=0.5)
+        self.assertEqual(set(HotPost.objects.values_list('rank', flat=True)), set([9.0, 8.0, 7.0, 6.0, 5.0, 4.0, 0.5]))
+        for page_size in (1, 2, 3):
+            self.assertEqual(self.top_ids(page_size), self.expected_ids())
+    
+    def test_up_vote(self):
+        Post.objects.filter(post_id=self.posts[2].post_id).update(rank=8.5)
+        Post.objects.filter(post_id=self.posts[3].post_id).update(rank=3.5)
+        self.assertTrue(HotPost.objects.filter(post_id=self.posts[2].post_id).exists())
+        self.assertFalse(HotPost.objects.filter(post_id=self.posts[3].post_id).exists())
+        self.assertEqual(self.top_ids(1), self.expected_ids())
+    
+    def test_window_size(self):
+        settings.HOT_WINDOW_SIZE, size = 2, settings.HOT_WINDOW_SIZE
+        try:
+            HotPost.refresh_window()
+        finally:
+            settings.HOT_WINDOW_SIZE = size
+        
+        self.assertEqual(list(HotWindow.objects.values_list('size', flat=True)), [2])
+        self.assertEqual([post.rank for post in Post.hot_posts(0, 10)], [10.0])
+
+
+@requires_postgresql
+class CommentPathTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test', email='test@tangleon.com', activation_code='test', 
+                                        activation_code_expiry=datetime.datetime.now(), updated_by='test', created_by='test')
+        self.post = create_post(comment_count=100)
+        self.comment_path_min_count = settings.COMMENT_PATH_MIN_COUNT
+        settings.COMMENT_PATH_MIN_COUNT = 1
+        Comment._has_sort_paths = None
+    
+    def tearDown(self):
+        settings.COMMENT_PATH_MIN_COUNT = self.comment_path_min_count
+        Comment._has_sort_paths = None
+    
+    def add_comment(self, rank, reply_to=None):
+        return Comment.objects.create(post=self.post, reply_to=reply_to, user=self.user, comment_text='comment', rank=rank, created_by='test')
+    
+    def add_thread(self):
+        """
+        Returns ids of comments of a thread in depth first order, replies by rank
+        """
+        a = self.add_comment(3)
+        b = self.add_comment(2)
+        a1 = self.add_comment(1, a)
+        a2 = self.add_comment(2, a)
+        a21 = self.add_comment(0, a2)
+        b1 = self.add_comment(0, b)
+        b11 = self.add_comment(0, b1)
+        b12 = self.add_comment(0, b1)
+        return [comment.comment_id for comment in (a, a2, a21, a1, b, b1, b11, b12)]
+    
+    def path_ids(self, max_comments, count):
+        """
+        Returns ids of comments of all pages read by sort paths in depth first order
+        """
+        comment_ids = []
+        after = None
+        while True:
+            roots = self.post.load_comments(AnonymousUser(), after=after, max_comments=max_comments)
+            self.assertEqual(roots.param, 'after')
+            self.assertEqual(len(roots.loaded), min(max_comments, count - len(comment_ids)))
+            
+            # Replies whose parent is on previous page are top comments of page
+            stack = list(reversed(roots))
+            while stack:
+                comment = stack.pop()
+                comment_ids.append(comment.comment_id)
+                stack.extend(reversed(comment.replies))
+            
+            if not roots.next_cursor:
+                return comment_ids
+            after = paging.Cursor.decode(roots.next_cursor)
+    
+    def test_pages(self):
+        run_script('comment_sort_path.sql')
+        expected = self.add_thread()
+        for max_comments in (1, 2, 3, 7, 8):
+            self.assertEqual(self.path_ids(max_comments, len(expected)), expected)
+    
+    def test_rank_change(self):
+        run_script('comment_sort_path.sql')
+        a, a2, a21, a1, b, b1, b11, b12 = self.add_thread()
+        
+        # Comment and its reply are ranked down by one statement like CommentVote.flush_counts, in both row orders
+        cursor = connection.cursor()
+        cursor.execute('''UPDATE app_comment SET rank = CASE comment_id WHEN %s THEN 1 ELSE 0 END WHERE comment_id IN (%s, %s)''', [a, a, a2])
+        self.assertEqual(self.path_ids(3, 8), [b, b1, b11, b12, a, a1, a2, a21])
+        
+        cursor.execute('''UPDATE app_comment SET rank = CASE comment_id WHEN %s THEN 3 ELSE 2 END WHERE comment_id IN (%s, %s)''', [a21, a2, a21])
+        cursor.execute('''UPDATE app_comment SET rank = CASE comment_id WHEN %s THEN 3 ELSE 5 END WHERE comment_id IN (%s, %s)''', [a, a2, a])
+        cursor.close()
+        self.assertEqual(self.path_ids(3, 8), [a, a2, a21, a1, b, b1, b11, b12])
+    
+    def test_invalid_after(self):
+        run_script('comment_sort_path.sql')
+        self.add_thread()
+        Post.objects.filter(post_id=self.post.post_id).update(tags='test')
+        for key in ('1e400,1', 'nan,1', 'inf,1', '1,2,3', str(10 ** 400) + ',1'):
+            after = base64.urlsafe_b64encode('a:' + key)
+            response = self.client.get(self.post.get_absolute_url(), {'after': after})
+            self.assertEqual(response.status_code, 200)
+    
+    def test_without_sort_paths(self):
+        expected = self.add_thread()
+        roots = self.post.load_comments(AnonymousUser(), max_comments=100)
+        self.assertFalse(Comment.has_sort_paths())
+        self.assertEqual(len(roots.loaded), len(expected))
+
+
+class FragmentsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test', email='test@tangleon.com', activation_code='test', 
+                                        activation_code_expiry=datetime.datetime.now(), updated_by='test', created_by='test')
+        self.post = create_post(comment_count=1)
+        self.comment = Comment.objects.create(post=self.post, user=self.user, comment_text='comment', rank=0, created_by='test')
+        self.request = RequestFactory().get(self.post.get_absolute_url(), CSRF_COOKIE='token')
+        fragments.invalidate(self.post.post_id)
+    
+    def tearDown(self):
+        cache.run_after_commit()
+    
+    def render(self, signed_in, votes=None, get_counts=None):
+        def comments_context():
+            self.post.comments = self.post.load_comments(AnonymousUser(), max_comments=10)
+            return {'post': self.post, 'signed_in': signed_in, 'utc_now': datetime.datetime.now()}
+        
+        return fragments.render(self.request, 'app/webparts/comments.html', comments_context, self.post.post_id, 
+                                ('comments', signed_in), votes, get_counts)
+    
+    def test_signed_in(self):
+        self.assertIn('comment-reply-%s' % self.comment.comment_id, self.render(True))
+        self.assertNotIn('comment-reply-%s' % self.comment.comment_id, self.render(False))
+    
+    def test_votes(self):
+        marker = 'comment-%s' % self.comment.comment_id
+        self.assertNotIn('up-vote-on', self.render(True))
+        self.assertIn('class="up-vote up-vote-on" data-vote="%s"' % marker, self.render(True, {marker: 1}))
+        self.assertNotIn(fragments.CSRF_PLACEHOLDER, self.render(True))
+        self.assertIn("value='token'", self.render(True))
+    
+    def test_invalidate_after_commit(self):
+        # Page rendered by another request after invalidation and before commit misses the new comment
+        fragments.invalidate(self.post.post_id)
+        self.render(True)
+        reply = Comment.objects.create(post=self.post, user=self.user, comment_text='reply', rank=1, created_by='test')
+        self.assertNotIn('comment-reply-%s' % reply.comment_id, self.render(True))
+        
+        cache.run_after_commit()
+        self.assertIn('comment-reply-%s' % reply.comment_id, self.render(True))
+    
+    def test_vote_counts(self):
+        # Votes don't invalidate fragments, current counts are injected into cached html
+        marker = 'comment-%s' % self.comment.comment_id
+        self.assertIn('data-votes="%s">' % marker, self.render(True))
+        Comment.objects.filter(comment_id=self.comment.comment_id).update(votes=7)
+        get_counts = lambda markers: dict(('comment-%s' % comment_id, votes) for comment_id, votes in
+                                          Comment.get_vote_counts([long(m.split('-')[1]) for m in markers]).iteritems())
+        html = self.render(True, get_counts=get_counts)
+        self.assertRegexpMatches(html, r'data-votes="%s">\s*7\s*<' % marker)
+        self.assertEqual(fragments.inject_counts(html, lambda markers: {}), html)
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test', email='test@tangleon.com', activation_code='test', 
+                                        activation_code_expiry=datetime.datetime.now(), updated_by='test', created_by='test')
+        self.post = create_post()
+    
+    def test_comment_count(self):
+        self.assertEqual(User.get_cached(self.user.user_id).comment_count, 0)
+        Comment.save_comment(self.user, self.post.post_id, self.post.slug, 'comment')
+        self.assertEqual(User.get_cached(self.user.user_id).comment_count, 1)
+    
+    @requires_postgresql
+    def test_up_votes(self):
+        run_script('compute_rank.sql')
+        run_script('vote.sql')
+        self.assertEqual(User.get_cached(self.user.user_id).up_votes, 0)
+        PostVote.up_vote(self.user, self.post.post_id)
+        self.assertEqual(User.get_cached(self.user.user_id).up_votes, 1)
+
+
+class FlashMessageTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test', email='test@tangleon.com', activation_code='test', 
+                                        activation_code_expiry=datetime.datetime.now(), updated_by='test', created_by='test')
+    
+    def tearDown(self):
+        cache.run_after_commit()
+    
+    def test_flag_after_commit(self):
+        self.assertEqual(FlashMessage.get_messages(self.user), [])
+        FlashMessage.add_info('saved', self.user)
+        
+        # Concurrent request reading messages before commit leaves flag to commit of message
+        self.assertIs(cache.get_value('flash:%s' % self.user.user_id), False)
+        cache.run_after_commit()
+        self.assertEqual([flash.flash_text for flash in FlashMessage.get_messages(self.user)], ['saved'])
+        self.assertEqual(FlashMessage.get_messages(self.user), [])
+
+
+class MarkupTest(SimpleTestCase):
+    TEXTS = ['plain text', '**bold** and _em_\n\n* one\n* two', 'a <b>tag</b> & <script>alert(1)</script> [link](http://tangleon.com)',
+             '    code\n\n> quote', u'unicode \u00e9 text']
+    
+    def test_text_html(self):
+        template = Template('{% load markup2 %}{{ value|striptags|markdown2 }}')
+        for text in self.TEXTS:
+            self.assertEqual(markup.text_html(text), template.render(Context({'value': text})))
+    
+    def test_empty_text(self):
+        self.assertEqual(markup.text_html(''), None)
+        self.assertEqual(Post(description=None).get_description_html(), '')
+        self.assertEqual(Comment(comment_text='').get_comment_html(), '')
+    
+    def test_stored_html(self):
+        self.assertEqual(Post(description='text', description_html='<p>stored</p>').get_description_html(), '<p>stored</p>')
+        self.assertEqual(Comment(comment_text='text', comment_html='<p>stored</p>').get_comment_html(), '<p>stored</p>')
+    
+    def test_fallback_html(self):
+        for text in self.TEXTS:
+            self.assertEqual(Post(description=text).get_description_html(), markup.text_html(text))
+            self.assertEqual(Comment(comment_text=text).get_comment_html(), markup.text_html(text))
+
+
+class StoredMarkupTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test', email='test@tangleon.com', activation_code='test', 
+                                        activation_code_expiry=datetime.datetime.now(), updated_by='test', created_by='test')
+        self.post = create_post(description='**abusive** <http://tangleon.com>', description_html='<p>abusive</p>', tags='test')
+        self.comment = Comment.objects.create(post=self.post, user=self.user, comment_text='**abusive**', comment_html='<p>abusive</p>', created_by='test')
+    
+    def test_edit(self):
+        # Moderator edits text in admin, stored html follows it
+        self.post.description = 'edited'
+        self.post.save()
+        self.comment.comment_text = 'edited'
+        self.comment.save()
+        self.assertEqual(Post.objects.get(post_id=self.post.post_id).get_description_html(), markup.text_html('edited'))
+        self.assertEqual(Comment.objects.get(comment_id=self.comment.comment_id).get_comment_html(), markup.text_html('edited'))
+    
+    def test_admin_forms(self):
+        request = RequestFactory().get('/admin/')
+        request.user = auth_models.AnonymousUser()
+        self.assertNotIn('description_html', admin.site._registry[Post].get_form(request).base_fields)
+        self.assertNotIn('comment_html', admin.site._registry[Comment].get_form(request).base_fields)
+    
+    def test_meta_description(self):
+        # Meta descriptions render markdown before stripping tags, so autolinks are kept
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertContains(response, '<meta name="description" content="abusive http://tangleon.com')
+
+
+class PostIndexTest(SimpleTestCase):
+    def test_listing_keys(self):
+        self.assertEqual(postindex.listing_keys(3, True, 'Python,python,Django'),
+                         ['posts', 'posts:image', 'channel:3', 'tag:django', 'tag:python'])
+        self.assertEqual(postindex.listing_keys(None, False, None), ['posts'])
+
+    def test_listing_pages(self):
+        listing = postindex.Listing()
+        for post_id, rank in [(1, 5.0), (2, 7.0), (3, 5.0), (4, 1.0)]:
+            listing.add(post_id, rank)
+        
+        self.assertEqual(listing.page('top', None, 0, 10), [2, 3, 1, 4])
+        self.assertEqual(listing.page('top', [5.0, 3], 0, 2), [1, 4])
+        self.assertEqual(listing.page('new', None, 1, 2), [3, 2])
+        self.assertEqual(listing.page('new', [3], 0, 10), [2, 1])
+        
+        listing.remove(3, 5.0)
+        listing.remove(3, 5.0)
+        self.assertEqual(listing.page('top', None, 0, 10), [2, 1, 4])
+        self.assertEqual(listing.page('new', None, 0, 10), [4, 2, 1])
+
+
+@requires_postgresql
+class IndexedPostsTest(TestCase):
+    """
+    Listings served by post index running in this process, index is filled directly because loader can't see test data
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = settings.POST_INDEX_SOCKET
+        settings.POST_INDEX_SOCKET = os.path.join(self.directory, 'index.sock')
+        self.server = postindex.Server(settings.POST_INDEX_SOCKET)
+        self.server.index.is_ready = True
+        threading.Thread(target=self.server.serve_forever).start()
+        
+        self.posts = [create_post(rank=float(r)) for r in range(1, 7)]
+        for post in self.posts:
+            self.server.index.put(post.post_id, post.rank, ['posts'])
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        settings.POST_INDEX_SOCKET = self.socket
+        shutil.rmtree(self.directory)
+    
+    def test_muted_posts(self):
+        # Index drops muted posts only when they are reloaded
+        Post.objects.filter(post_id__in=[self.posts[4].post_id, self.posts[1].post_id]).update(is_muted=True)
+        expected = [post.post_id for post in reversed(self.posts) if post not in (self.posts[4], self.posts[1])]
+        for page_size in (1, 2, 3):
+            self.assertEqual(page_ids(lambda cursor: Post.indexed_posts('posts', 0, page_size, False, cursor)), expected)
+    
+    def test_stale_ranks(self):
+        # Ranks in database change before index reloads touched posts, pages follow order and ranks of index
+        for i, post in enumerate(self.posts):
+            Post.objects.filter(post_id=post.post_id).update(rank=float(i % 2))
+        
+        expected = [post.post_id for post in reversed(self.posts)]
+        for page_size in (1, 2, 4):
+            self.assertEqual(page_ids(lambda cursor: Post.indexed_posts('posts', 0, page_size, False, cursor)), expected)
+    
+    def test_tagged_top_pages(self):
+        # Top tag pages seek on ranks copied to post tags, only new tag pages are read from index
+        self.server.index.put(self.posts[0].post_id, self.posts[0].rank, ['tag:python'])
+        self.assertEqual(list(Post.tagged_posts('python', 0, 10, False, None)), [])
+        self.assertEqual([post.post_id for post in Post.tagged_posts('python', 0, 10, True, None)], [self.posts[0].post_id])
+    
+    def test_touch(self):
+        postindex.touch(post.post_id for post in self.posts[:2])
+        for _ in range(100):
+            if self.server.pending:
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual(self.server.pending, set(post.post_id for post in self.posts[:2]))
+
+
+@requires_postgresql
+class TaggedPostsTest(TestCase):
+    def setUp(self):
+        Tag.add_tags(['Python', 'django'], 'test')
+        self.posts = [create_post(tags='python,Django' if i % 2 else 'Python', rank=float(i % 4)) for i in range(10)]
+        PostTag.add_post_tags(self.posts)
+        
+        # Ranks of posts change before trigger of db-scripts/post_tags.sql copies them to post tags
+        Post.objects.filter(post_id__in=[post.post_id for post in self.posts[:3]]).update(rank=10)
+    
+    def test_top_pages(self):
+        expected = [post.post_id for post in sorted(self.posts, key=lambda post: (post.rank, post.post_id), reverse=True)]
+        for page_size in (1, 3, 4, 10):
+            self.assertEqual(page_ids(lambda cursor: Post.tagged_posts('PYTHON', 0, page_size, False, None, cursor)), expected)
+            self.assertEqual(page_ids(lambda cursor: Post.room_posts('python', 0, page_size, False, None, cursor)), expected)
+            self.assertEqual(page_ids(lambda cursor: Post.tagged_posts('django', 0, page_size, False, None, cursor)),
+                             [post_id for post_id in expected if post_id in set(post.post_id for post in self.posts[1::2])])
+    
+    def test_new_pages(self):
+        expected = [post.post_id for post in reversed(self.posts)]
+        self.assertEqual(page_ids(lambda cursor: Post.tagged_posts('python', 0, 3, True, None, cursor)), expected)
+        self.assertEqual(page_ids(lambda cursor: Post.room_posts('django', 0, 3, True, None, cursor)), [])
+    
+    def test_search(self):
+        now = datetime.datetime.now()
+        channel = Channel.objects.create(url='http://flask.com/rss', link='http://flask.com', title='Flask News', is_default=False,
+                                         sync_on=now, published=now, updated_by='test', created_by='test')
+        post = create_post(title='Micro frameworks', channel=channel)
+        self.assertEqual(page_ids(lambda cursor: Post.tag_posts('flask', 0, 3, True, None, cursor)), [post.post_id])
+        self.assertEqual(page_ids(lambda cursor: Post.tag_posts('JANG', 0, 3, True, None, cursor)),
+                         [p.post_id for p in reversed(self.posts[1::2])])
+    
+    def test_tag_again(self):
+        Tag.add_tags(['PYTHON', 'flask'], 'test')
+        PostTag.add_post_tags(self.posts)
+        self.assertEqual(Tag.objects.filter(name__iexact='python').count(), 1)
+        self.assertEqual(PostTag.objects.count(), 15)
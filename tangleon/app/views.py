@@ -5,6 +5,8 @@ Contains views for TangleOn app
 """
 
 import re
+import sys
+import copy
 import urllib
 import datetime
 import logging
@@ -23,8 +25,8 @@ from django.template.loader import get_template
 from django.template import Context
 from django.conf import settings
 
-from tangleon import TangleOnError
-from tangleon.app import login_user, logout_user, scraper
+from tangleon import TangleOnError, paging
+from tangleon.app import AnonymousUser, login_user, logout_user, scraper, fragments
 from tangleon.app.forms import SignUp, ChangePassword, PasswordReset, SubmitLinkPost, SubmitTextPost
 from tangleon.app.models import User, Credential, Follow, Channel, Post, Comment, Tag, Subscription, Pin, PostVote, CommentVote, Message, FbUser, FlashMessage
 from tangleon.app.decorators import login_required, anonymous_required
@@ -62,7 +64,8 @@ def index(request, by_new=False, page_index=0):
               'absolute_url': reverse('app_index'),
               'absolute_url_by_new': reverse('app_index_new'),
               'active': 'new' if by_new else 'top'}
-    posts = Post.get_posts(int(page_index), settings.PAGE_SIZE, by_new, request.app_user)
+    cursor = get_cursor(request)
+    posts = Post.front_page(int(page_index), settings.PAGE_SIZE, by_new, request.app_user, cursor=cursor)
     top_tags = Tag.top_tags()
     top_channels = Channel.top_channels()
     prev_url, next_url = paginated_url(request.resolver_match.url_name, posts, [page_index])
@@ -96,7 +99,8 @@ def search(request, by_new=False, page_index=0):
                   'absolute_url': reverse('app_search') + query,
                   'absolute_url_by_new': reverse('app_search_new') + query,
                   'active': 'new' if by_new else 'top'}
-        posts = Post.tag_posts(q, int(page_index), settings.PAGE_SIZE, by_new, request.app_user)
+        cursor = get_cursor(request)
+        posts = Post.tag_posts(q, int(page_index), settings.PAGE_SIZE, by_new, request.app_user, cursor)
                 
         top_tags = Tag.top_tags()
         top_channels = Channel.top_channels()                
@@ -115,7 +119,8 @@ def tag_posts(request, tag_name, by_new=False, page_index=0):
               'absolute_url': reverse('app_tag', args=[tag_name]),
               'absolute_url_by_new': reverse('app_tag_new', args=[tag_name]),
               'active': 'new' if by_new else 'top'}
-    posts = Post.tag_posts(tag_name, int(page_index), settings.PAGE_SIZE, by_new, request.app_user)
+    cursor = get_cursor(request)
+    posts = Post.tagged_posts(tag_name, int(page_index), settings.PAGE_SIZE, by_new, request.app_user, cursor)
     try:
         tag = Tag.objects.get(name__iexact=tag_name)
         pin = None if request.app_user.is_anonymous() else Pin.objects.get(user=request.app_user, tag=tag) 
@@ -136,12 +141,12 @@ def channel_posts(request, channel_id, by_new=False, page_index=0):
     Display posts from particular source like TechCrunch or Engadget
     """
     channel = get_object_or_404(Channel, channel_id=channel_id)    
-    channel.sync(request.app_user)
     source = {'title': channel.title,
               'absolute_url': channel.get_absolute_url(),
               'absolute_url_by_new': reverse('app_channel_new', args=[channel.channel_id]),
               'active': 'new' if by_new else 'top'}
-    posts = channel.get_posts(int(page_index), settings.PAGE_SIZE, by_new, request.app_user)
+    cursor = get_cursor(request)
+    posts = channel.get_posts(int(page_index), settings.PAGE_SIZE, by_new, request.app_user, cursor)
     try:
         subscription = Subscription.objects.get(channel=channel, user=request.app_user) if request.app_user.is_authenticated() else None
     except Subscription.DoesNotExist:
@@ -170,7 +175,8 @@ def user_posts(request, username, by_new=False, page_index=0):
         follow = Follow.objects.filter(follower=request.app_user, following=user).all()
         if follow: follow = follow[0]
         
-    posts = user.get_posts(int(page_index), settings.PAGE_SIZE, by_new, request.app_user)
+    cursor = get_cursor(request)
+    posts = user.get_posts(int(page_index), settings.PAGE_SIZE, by_new, request.app_user, cursor)
     prev_url, next_url = paginated_url(request.resolver_match.url_name, posts, [username, page_index])
     
     return render_response(request, 'app/user.html', locals()) 
@@ -193,7 +199,8 @@ def user_comments(request, username, page_index=0):
         follow = Follow.objects.filter(follower=request.app_user, following=user).all()
         if follow: follow = follow[0]
 
-    posts = user.get_by_comments(int(page_index), settings.PAGE_SIZE, request.app_user)
+    cursor = get_cursor(request)
+    posts = user.get_by_comments(int(page_index), settings.PAGE_SIZE, request.app_user, cursor)
     prev_url, next_url = paginated_url('app_user_comments', posts, [username, page_index])
     
     return render_response(request, 'app/user.html', locals())
@@ -216,7 +223,8 @@ def user_messages(request, username, page_index=0):
         follow = Follow.objects.filter(follower=request.app_user, following=user).all()
         if follow: follow = follow[0]
 
-    posts = user.get_by_messages(int(page_index), settings.PAGE_SIZE, request.app_user)
+    cursor = get_cursor(request)
+    posts = user.get_by_messages(int(page_index), settings.PAGE_SIZE, request.app_user, cursor)
     prev_url, next_url = paginated_url('app_user_messages', posts, [username, page_index])
     
     return render_response(request, 'app/user.html', locals()) 
@@ -240,7 +248,8 @@ def user_votes(request, username, page_index=0):
         follow = Follow.objects.filter(follower=request.app_user, following=user).all()
         if follow: follow = follow[0]
 
-    posts = user.get_by_votes(int(page_index), settings.PAGE_SIZE, request.app_user)
+    cursor = get_cursor(request)
+    posts = user.get_by_votes(int(page_index), settings.PAGE_SIZE, request.app_user, cursor)
     prev_url, next_url = paginated_url('app_user_votes', posts, [username, page_index])
     
     return render_response(request, 'app/user.html', locals())    
@@ -252,7 +261,7 @@ def read_post(request, post_id, slug, comment_id=None):
     """
     try:
         try:
-            max_comments = 200 if int(request.GET.get('limit', 200)) > 200 else request.GET.get('limit', 200)
+            max_comments = min(int(request.GET.get('limit', 200)), 200)
         except:
             max_comments = 200
         
@@ -261,12 +270,52 @@ def read_post(request, post_id, slug, comment_id=None):
             
         post_id = long(post_id)        
         comment_id = long(comment_id) if comment_id else None
-        post = Post.read_post(post_id, slug, request.app_user, comment_id, max_comments)        
+        more = paging.Cursor.decode(request.GET.get('more', None))
+        if more and (len(more.key) != 2 or comment_id):
+            more = None
+        
+        # Sort path cursor of comments is (-rank, comment_id) pairs cast to double precision[] and part of fragment key
+        after = paging.Cursor.decode(request.GET.get('after', None))
+        if after and (after.backward or not after.key or len(after.key) % 2 or
+                      not all(isinstance(v, (int, long, float)) and -sys.float_info.max <= v <= sys.float_info.max for v in after.key)):
+            after = None
+        
+        fragments_cached = not comment_id and not more
+        post = Post.read_post(post_id, slug, request.app_user, comment_id, 0 if fragments_cached else max_comments, more, after)        
     except Post.DoesNotExist:
         raise Http404()    
     
     markdown_help_text = MARK_DOWN_TEXT
     
+    if fragments_cached and not post.is_muted:
+        # Fragments are rendered without request and votes of user and comments are loaded only if they are not cached,
+        # votes of user and current vote counts are injected into them
+        shared_post = copy.copy(post)
+        shared_post.vote_index = None
+        signed_in = request.app_user.is_authenticated()
+        
+        def body_context():
+            return {'post': shared_post, 'preview_img_width': 75, 'preview_img_height': 75, 'show_description': True, 
+                    'utc_now': datetime.datetime.now()}
+        
+        def comments_context():
+            shared_post.comments = shared_post.load_comments(AnonymousUser(), after=after, max_comments=max_comments)
+            return {'post': shared_post, 'signed_in': signed_in, 'utc_now': datetime.datetime.now()}
+        
+        def vote_counts(markers):
+            comment_ids = [long(marker[len('comment-'):]) for marker in markers if marker.startswith('comment-')]
+            counts = dict(('comment-%s' % comment_id, votes) for comment_id, votes in Comment.get_vote_counts(comment_ids).iteritems())
+            counts['post-%s' % post_id] = post.votes
+            return counts
+        
+        votes = dict(('comment-%s' % voted_id, vote) for voted_id, vote in CommentVote.get_votes(request.app_user, post_id).iteritems())
+        votes['post-%s' % post_id] = post.vote_index
+        body_html = fragments.render(request, 'app/webparts/post_content.html', body_context, post_id, ('body',), votes, vote_counts)
+        comments_html = fragments.render(request, 'app/webparts/comments.html', comments_context, post_id, 
+                                         ('comments', signed_in, max_comments, after and after.encode()), votes, vote_counts)
+    else:
+        fragments_cached = False
+    
     return render_response(request, 'app/post.html', locals())
 
 def rate_post(request, post_id, slug, comment_id=None):
@@ -920,24 +969,29 @@ def render_response(request, *args, **kwargs):
     return render_to_response(*args, **kwargs)
 
         
+def get_cursor(request):
+    """
+    Returns listing cursor from query string of the request
+    """
+    return paging.Cursor.decode(request.GET.get('cursor', None))
+
+        
 def paginated_url(url_name, result_set, args, qs=None):
     """
-    Returns previous and next page urls
+    Returns previous and next page urls with opaque cursors of the result set page
     """
     prev_url = None
     next_url = None
-    qs = '?' + urllib.urlencode(qs) if qs else ''
-    page_index = int(args[-1])
-    
-    if page_index == 1:
-        prev_url = reverse(url_name, args=args[:-1]) + qs
-    elif page_index > 1 :
-        args[-1] = page_index - 1
-        prev_url = reverse(url_name, args=args) + qs
-    
-    if len(result_set) == settings.PAGE_SIZE:
-        args[-1] = page_index + 1
-        next_url = reverse(url_name, args=args) + qs
+    qs = dict(qs) if qs else {}
+    url = reverse(url_name, args=args[:-1])
+    
+    if result_set.prev_cursor:
+        qs['cursor'] = result_set.prev_cursor
+        prev_url = url + '?' + urllib.urlencode(qs)
+    
+    if result_set.next_cursor:
+        qs['cursor'] = result_set.next_cursor
+        next_url = url + '?' + urllib.urlencode(qs)
         
     return prev_url, next_url
     
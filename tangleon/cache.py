@@ -0,0 +1,99 @@
+"""
+Versioned namespaces over django cache for sharing query results among all web workers
+"""
+
+import time
+import hashlib
+import threading
+
+from django.db import connection
+from django.core.cache import cache
+
+_after_commit = threading.local()
+
+
+def version_key(namespace):
+    return 'tangleon:version:%s' % namespace
+
+
+def get_version(namespace):
+    """
+    Returns current version of namespace
+    """
+    version = cache.get(version_key(namespace))
+    if version is None:
+        # Starting from current time so values cached before version key eviction are never read again
+        cache.add(version_key(namespace), int(time.time() * 1000), None)
+        version = cache.get(version_key(namespace), 0)
+
+    return version
+
+
+def bump_version(namespace):
+    """
+    Invalidates all values cached in namespace
+    """
+    try:
+        cache.incr(version_key(namespace))
+    except ValueError:
+        get_version(namespace)
+
+
+def after_commit(func, *args):
+    """
+    Calls func with args now in autocommit, otherwise once transaction of current request has ended, it's run by
+    AppMiddleware because Django 1.6 has no commit hooks
+    """
+    if connection.get_autocommit():
+        func(*args)
+        return
+
+    calls = _after_commit.__dict__.setdefault('calls', [])
+    if (func, args) not in calls:
+        calls.append((func, args))
+
+
+def run_after_commit():
+    """
+    Runs calls deferred by after_commit
+    """
+    calls, _after_commit.calls = getattr(_after_commit, 'calls', []), []
+    for func, args in calls:
+        func(*args)
+
+
+def bump_version_on_commit(namespace):
+    """
+    Invalidates namespace now and again after commit, values cached by other requests before commit don't have changes
+    of current transaction
+    """
+    bump_version(namespace)
+    after_commit(bump_version, namespace)
+
+
+def get_value(name):
+    """
+    Returns value cached by set_value, None if it is not cached
+    """
+    return cache.get('tangleon:value:%s' % name)
+
+
+def set_value(name, value, timeout=None):
+    cache.set('tangleon:value:%s' % name, value, timeout)
+
+
+def make_key(namespace, parts):
+    return 'tangleon:%s:%s:%s' % (namespace, get_version(namespace), hashlib.md5(repr(parts)).hexdigest())
+
+
+def get_or_set(namespace, parts, func, timeout):
+    """
+    Returns value cached for parts in current version of namespace, otherwise caches and returns result of func
+    """
+    key = make_key(namespace, parts)
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, timeout)
+
+    return value
@@ -100,7 +100,7 @@ class AllFeed(ChannelFeed):
         return channel
     
     def items(self, channel): 
-        return Post.get_posts(0, MAX_FEEDS, channel.by_new, channel.request.app_user, channel.request.GET.get('text_posts', 'true').lower() == 'true')            
+        return Post.front_page(0, MAX_FEEDS, channel.by_new, channel.request.app_user, channel.request.GET.get('text_posts', 'true').lower() == 'true')            
     
     def link(self, channel):
         return reverse('app_index_new') if channel.by_new else reverse('app_index')
@@ -123,7 +123,7 @@ class TagFeed(ChannelFeed):
         return reverse('app_tag_new', args=[channel.title]) if channel.by_new else reverse('app_tag', args=[channel.title])
     
     def items(self, channel):
-        return [post for post in Post.tag_posts(channel.title, 0, 50, channel.by_new, channel.request.app_user) if post.img_url][:30]
+        return [post for post in Post.tagged_posts(channel.title, 0, 50, channel.by_new, channel.request.app_user) if post.img_url][:30]
     
     
 
@@ -0,0 +1,102 @@
+"""
+Keyset (seek) pagination of listings with opaque cursors
+"""
+
+import base64
+
+
+class Cursor(object):
+    """
+    Position in a listing, it holds sort key of the row next or previous page should start after
+    """
+    def __init__(self, key, backward=False):
+        self.key = tuple(key)
+        self.backward = backward
+
+    def encode(self):
+        """
+        Returns url safe opaque string of cursor
+        """
+        value = ('b:' if self.backward else 'a:') + ','.join(repr(v) if isinstance(v, float) else str(v) for v in self.key)
+        return base64.urlsafe_b64encode(value).rstrip('=')
+
+    @classmethod
+    def decode(cls, value):
+        """
+        Returns cursor from opaque string or None if it is empty or invalid
+        """
+        if not value:
+            return None
+
+        try:
+            value = base64.urlsafe_b64decode(str(value) + '=' * (-len(value) % 4))
+            direction, key = value.split(':', 1)
+            if direction not in ('a', 'b'):
+                return None
+
+            return cls([_parse(v) for v in key.split(',')], direction == 'b')
+        except (TypeError, ValueError, UnicodeError):
+            return None
+
+
+class Keyset(object):
+    """
+    Descending sort key of a listing, columns are used in SQL and attrs to read key from fetched rows
+    """
+    def __init__(self, columns, attrs):
+        self.columns = columns
+        self.attrs = attrs
+
+    def fit(self, cursor):
+        """
+        Returns cursor if it is positioned on this keyset otherwise None
+        """
+        return cursor if cursor and len(cursor.key) == len(self.columns) else None
+
+    def seek(self, cursor):
+        """
+        Returns SQL condition, ORDER BY clause and condition parameters to read rows after cursor
+        """
+        backward = cursor.backward if cursor else False
+        order_by = ', '.join('%s %s' % (column, 'ASC' if backward else 'DESC') for column in self.columns)
+        if not cursor:
+            return '', order_by, []
+
+        condition = 'AND (%s) %s (%s)' % (', '.join(self.columns), '>' if backward else '<', ', '.join(['%s'] * len(self.columns)))
+        return condition, order_by, list(cursor.key)
+
+    def key(self, row):
+        return tuple(getattr(row, attr) for attr in self.attrs)
+
+    def page(self, rows, page_size, cursor=None, page_index=0):
+        """
+        Returns page of rows fetched with one extra row (page_size + 1) to find out if more rows exist
+        """
+        backward = cursor.backward if cursor else False
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backward:
+            rows.reverse()
+
+        has_next = True if backward else has_more
+        has_prev = has_more if backward else bool(cursor or page_index)
+        return Page(rows,
+                    Cursor(self.key(rows[-1])).encode() if rows and has_next else None,
+                    Cursor(self.key(rows[0]), True).encode() if rows and has_prev else None)
+
+
+class Page(list):
+    """
+    Rows of a listing page with opaque cursors of next and previous pages
+    """
+    def __init__(self, rows=(), next_cursor=None, prev_cursor=None):
+        super(Page, self).__init__(rows)
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def _parse(value):
+    try:
+        return long(value)
+    except ValueError:
+        return float(value)
@@ -1,11 +1,29 @@
 """
 Compute ranks base on votes and date or up/down votes
+
+This module is the only definition of ranking, SQL functions of db-scripts/compute_rank.sql are generated 
+from it with "python manage.py rank_sql" and expressions of SQL mirror operations of Python functions
 """
 
 from datetime import datetime, timedelta
-from math import log, sqrt
+from math import log, sqrt, floor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 epoch = datetime(1970, 1, 1)
+EPOCH_OFFSET = 1134028003 # Seconds, hot ranks are counted from this time
+HOT_PERIOD = 45000 # Seconds, time in which ten times votes rank same as newer post
+HOT_DIGITS = 7
+WILSON_Z = 1.96 # 1.0 = 85%, 1.96 = 95%
+
+# SQL types of dialects for generated expressions, expressions only use float arithmetic so any version rounds same as Python
+DIALECTS = {
+    'postgresql': {'float': 'double precision'},
+    'sqlite': {'float': 'REAL'},
+}
 
 def epoch_seconds(date):
     """Returns the number of seconds from the epoch to date."""
@@ -18,8 +36,24 @@ def hot(votes, date):
     s = votes
     order = log(max(abs(s), 1), 10)
     sign = 1 if s > 0 else -1 if s < 0 else 0
-    seconds = epoch_seconds(date) - 1134028003
-    return round(order + sign * seconds / 45000, 7)
+    seconds = epoch_seconds(date) - EPOCH_OFFSET
+    return round_digits(order + sign * seconds / HOT_PERIOD, HOT_DIGITS)
+
+
+def hot_array(votes, dates):
+    """
+    Array version of hot, dates are epoch seconds or datetimes. Results are bit-compatible with hot, it needs NumPy
+    """
+    votes = numpy.asarray(votes)
+    dates = numpy.asarray(dates)
+    if dates.dtype == object:
+        dates = numpy.array([epoch_seconds(date) for date in dates.tolist()], dtype=numpy.float64)
+    
+    # Logarithm of NumPy may differ from math.log in last bit, votes have few distinct values so math.log is used
+    values, inverse = numpy.unique(numpy.abs(votes), return_inverse=True)
+    order = numpy.array([log(max(value, 1), 10) for value in values.tolist()], dtype=numpy.float64)[inverse]
+    seconds = dates - EPOCH_OFFSET
+    return round_digits_array(order + numpy.sign(votes) * seconds / HOT_PERIOD, HOT_DIGITS)
 
 
 def rating(ups, downs):
@@ -30,8 +64,115 @@ def rating(ups, downs):
     if n == 0:
         return 0
 
-    z = 1.96 #1.0 = 85%, 1.96 = 95%
+    z = WILSON_Z
     phat = float(ups) / n
     return (phat + z*z/(2*n) - z * sqrt((phat*(1-phat)+z*z/(4*n))/n))/(1+z*z/n)
+
+
+def rating_array(ups, downs):
+    """
+    Array version of rating, results are bit-compatible with rating, it needs NumPy
+    """
+    ups = numpy.asarray(ups)
+    n = ups + numpy.asarray(downs)
     
+    z = WILSON_Z
+    m = numpy.where(n == 0, 1, n)
+    phat = ups.astype(numpy.float64) / m
+    ratings = (phat + z*z/(2*m) - z * numpy.sqrt((phat*(1-phat)+z*z/(4*m))/m))/(1+z*z/m)
+    return numpy.where(n == 0, 0.0, ratings)
+
+
+def round_digits(value, ndigits):
+    """
+    Rounds half away from zero with float operations only, built in round rounds exact decimal value of float 
+    which SQL can't reproduce, so hot ranks of Python, NumPy and SQL are rounded with this
+    """
+    scale = 10.0 ** ndigits
+    sign = 1 if value > 0 else -1 if value < 0 else 0
+    return sign * floor(abs(value) * scale + 0.5) / scale
+
+
+def round_digits_array(values, ndigits):
+    """
+    Array version of round_digits, it needs NumPy
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    scale = 10.0 ** ndigits
+    return numpy.sign(values) * numpy.floor(numpy.abs(values) * scale + 0.5) / scale
+
+
+def round_array(values, ndigits):
+    """
+    Rounds array of floats same as built in round
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    scale = 10.0 ** ndigits
+    scaled = values * scale
+    rounded = numpy.rint(scaled) / scale
     
+    # rint rounds halves to even and scaled values carry error of multiplication, values close to half are left to round
+    fraction = numpy.abs(scaled - numpy.trunc(scaled))
+    doubtful = (numpy.abs(fraction - 0.5) <= numpy.abs(scaled) * 2.0 ** -50 + 1e-9) | ~(numpy.abs(scaled) < 2.0 ** 52)
+    for i in numpy.flatnonzero(doubtful):
+        rounded.flat[i] = round(values.flat[i], ndigits)
+    
+    return rounded
+    
+    
+
+
+def hot_sql(votes, seconds, dialect='postgresql'):
+    """
+    Returns SQL expression of hot for SQL expressions of integer votes and float epoch seconds of post date
+    """
+    sql_type = DIALECTS[dialect]
+    order = 'ln(CAST(CASE WHEN abs({v}) > 1 THEN abs({v}) ELSE 1 END AS {float})) / ln(CAST(10 AS {float}))'
+    sign = '(CASE WHEN {v} > 0 THEN 1 WHEN {v} < 0 THEN -1 ELSE 0 END)'
+    hot = (order + ' + ' + sign + ' * ({s} - {offset}) / {period}').format(v=votes, s=seconds, offset=EPOCH_OFFSET, period=HOT_PERIOD, float=sql_type['float'])
+    return round_digits_sql(hot, HOT_DIGITS, dialect)
+
+
+def round_digits_sql(value, ndigits, dialect='postgresql'):
+    """
+    Returns SQL expression of round_digits for SQL expression of float value
+    """
+    sql_type = DIALECTS[dialect]
+    rounded = '(CASE WHEN {v} > 0 THEN 1 WHEN {v} < 0 THEN -1 ELSE 0 END) * floor(abs({v}) * {scale} + CAST(0.5 AS {float})) / {scale}'
+    return rounded.format(v=value, scale='CAST(%r AS %s)' % (10.0 ** ndigits, sql_type['float']), float=sql_type['float'])
+
+
+def rating_sql(ups, downs, dialect='postgresql'):
+    """
+    Returns SQL expression of rating for SQL expressions of integer up and down votes
+    """
+    sql_type = DIALECTS[dialect]
+    rating = '({phat} + {z} * {z} / (2 * {n}) - {z} * sqrt(({phat} * (1 - {phat}) + {z} * {z} / (4 * {n})) / {n})) / (1 + {z} * {z} / {n})'
+    rating = rating.format(phat='(CAST({u} AS {float}) / ({u} + {d}))', z='CAST({z!r} AS {float})', n='({u} + {d})')
+    return ('CASE WHEN {u} + {d} = 0 THEN CAST(0 AS {float}) ELSE ' + rating + ' END').format(u=ups, d=downs, z=WILSON_Z, float=sql_type['float'])
+
+
+def sql_functions():
+    """
+    Returns PostgreSQL compute_rank functions, dates are converted to session local time same as naive dates of Django
+    and to epoch seconds with the same float operations as epoch_seconds
+    """
+    return '''-- Generated by "python manage.py rank_sql" from tangleon/rank.py, don't edit
+-- Compute ranks
+
+DROP FUNCTION IF EXISTS compute_rank(integer, timestamp with time zone);
+DROP FUNCTION IF EXISTS compute_rank(integer, integer);
+
+-- Compute rank based on time of submittion, same as rank.hot
+CREATE FUNCTION compute_rank(votes integer, post_date timestamp with time zone) RETURNS double precision AS $$
+        SELECT {hot};
+$$ LANGUAGE sql STABLE;
+
+
+-- Compute rank based on confidence of votes, same as rank.rating
+CREATE FUNCTION compute_rank(up_votes integer, down_votes integer) RETURNS double precision AS $$
+        SELECT {rating};
+$$ LANGUAGE sql IMMUTABLE;
+'''.format(hot=hot_sql('votes', '(CAST(extract(epoch FROM date_trunc(\'second\', post_date::timestamp)) AS bigint) + '
+                               'CAST(extract(microseconds FROM post_date::timestamp) AS integer) % 1000000 / CAST(1000000 AS double precision))'),
+           rating=rating_sql('up_votes', 'down_votes'))
@@ -107,12 +107,20 @@ else:
     SECRET_KEY = os.environ['TANGLE_ON_SECRET_KEY']
 
 # List of callables that know how to import templates from various sources.
-TEMPLATE_LOADERS = (
+TEMPLATE_SOURCE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
     'django.template.loaders.app_directories.Loader',
 #     'django.template.loaders.eggs.Loader',
 )
 
+# Compiled templates are kept by cached loader and all TangleOn templates are compiled at worker start (tangleon/wsgi.py),
+# templates are read from disk on every render if TANGLE_ON_TEMPLATE_CACHE is 0, it's 0 by default in DEBUG
+TEMPLATE_CACHE = os.environ.get('TANGLE_ON_TEMPLATE_CACHE', '0' if DEBUG else '1') == '1'
+if TEMPLATE_CACHE:
+    TEMPLATE_LOADERS = (('django.template.loaders.cached.Loader', TEMPLATE_SOURCE_LOADERS),)
+else:
+    TEMPLATE_LOADERS = TEMPLATE_SOURCE_LOADERS
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -153,6 +161,30 @@ INSTALLED_APPS = (
 
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 
+# Session store chosen by TANGLE_ON_SESSION_STORE, 'db' (default) reads database on every request, 'cache' reads
+# sessions from cache and writes them to database only when they change and 'cookie' keeps them in signed cookie with
+# no server storage
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cached_db',
+    'cookie': 'django.contrib.sessions.backends.signed_cookies',
+}[os.environ.get('TANGLE_ON_SESSION_STORE', 'db')]
+
+# Cache shared among all web workers for listings, memcached on production
+if DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['TANGLE_ON_CACHE_LOCATION'],
+        }
+    }
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -232,6 +264,24 @@ META_DESCRIPTION = ''
 PAGE_SIZE = 20
 STATIC_CONTENT_VERSION = 20 # An incremental value to force browser reload, it should only be incremented if static content updated
 MAX_COMMENT_LEGNTH = 1000
+COMMENT_LEVEL_LIMITS = (100, 20, 10, 5, 5, 5, 5, 5) # Replies shown per comment at each depth, deeper comments are loaded by continuation
+COMMENT_PATH_MIN_COUNT = 500 # Comments of posts with at least these many comments are paged depth first by sort path
+APP_USER_CACHE_TIMEOUT = 60 # Seconds, cached user of request is also invalidated on every save of user
+SIDEBAR_CACHE_TIMEOUT = 600 # Seconds, sidebar values of user are also invalidated on changes of pins, subscriptions, followings and messages
+MARKDOWN_CACHE_SIZE = 2000 # Number of rendered markdown texts kept by each worker for texts without stored html
+POST_FRAGMENT_CACHE_TIMEOUT = 300 # Seconds, rendered post body and comments are also invalidated on new comments
+FRONT_PAGE_CACHE_TIMEOUT = 60 # Seconds, cached pages are also refreshed on new posts and rank computation
+FRONT_PAGE_CACHED_PAGES = 5 # Number of top and new pages precomputed by refresh_front_page command
+POST_INDEX_SOCKET = os.environ.get('TANGLE_ON_POST_INDEX_SOCKET') # Unix socket of run_post_index command, post index is not used if not set
+POST_INDEX_TIMEOUT = 0.05 # Seconds, listings are read from database if post index doesn't respond in time
+HOT_WINDOW_SIZE = 1000 # Number of top posts served from hot window, applied to database (HotWindow) by compute_ranks
+SYNC_INTERVAL = 60 # Minutes, channels are synced by sync_channels command once in this interval
+SYNC_WORKERS = 4 # Number of channels synced concurrently by sync_channels command
+VOTE_WRITE_BEHIND = False # If True votes don't update post and comment counters, flush_votes command must be running
+VOTE_FLUSH_INTERVAL = 10 # Seconds, maximum staleness of vote counters with VOTE_WRITE_BEHIND
+SCRAPER_WORKERS = 8 # Maximum concurrent page fetches of RSS entries in a process
+SCRAPER_HOST_WORKERS = 2 # Maximum concurrent page fetches from one host
+SCRAPER_TIMEOUT = 10 # Seconds
 
 # Facebook settings
 if DEBUG:
@@ -27,6 +27,12 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tangleon.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Compiling all templates before first request, with preloaded app they are compiled once before workers fork
+from django.conf import settings
+if settings.TEMPLATE_CACHE:
+    from tangleon.app.preload import preload_templates
+    preload_templates()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)